@@ -0,0 +1,130 @@
+// Searches the index that build.py writes to search.json (see search.py for
+// its format). The index is only fetched once the search box is used.
+(function () {
+    'use strict';
+
+    var maxResults = 10;
+    var minWordLength = 2;
+    var digits = '0123456789abcdefghijklmnopqrstuvwxyz';
+
+    var form = document.getElementById('search');
+    var input = document.getElementById('search-input');
+    var results = document.getElementById('search-results');
+    var index = null;
+    var loading = null;
+
+    function load() {
+        if (loading === null) {
+            loading = fetch('search.json')
+                .then(function (response) { return response.json(); })
+                .then(function (data) {
+                    var terms = [];
+                    var previous = '';
+                    for (var i = 0; i < data.terms.length; ++i) {
+                        var term = data.terms[i];
+                        previous = previous.slice(0, digits.indexOf(term[0])) + term.slice(1);
+                        terms.push(previous);
+                    }
+                    index = {documents: data.documents, terms: terms, postings: data.postings};
+                });
+        }
+        return loading;
+    }
+
+    // The position of the first term that doesn't sort before prefix.
+    function firstTerm(prefix) {
+        var low = 0;
+        var high = index.terms.length;
+        while (low < high) {
+            var middle = (low + high) >> 1;
+            if (index.terms[middle] < prefix) {
+                low = middle + 1;
+            } else {
+                high = middle;
+            }
+        }
+        return low;
+    }
+
+    // Every document that has a term starting with word, with its score.
+    // Whole words count twice as much as prefixes.
+    function match(word) {
+        var scores = new Map();
+        for (var i = firstTerm(word); i < index.terms.length; ++i) {
+            var term = index.terms[i];
+            if (!term.startsWith(word)) {
+                break;
+            }
+            var factor = term.length === word.length ? 2 : 1;
+            var postings = index.postings[i];
+            var id = 0;
+            for (var j = 0; j < postings.length; j += 2) {
+                id += postings[j];
+                scores.set(id, (scores.get(id) || 0) + factor * postings[j + 1]);
+            }
+        }
+        return scores;
+    }
+
+    // The documents that match every word in query, best first.
+    function search(query) {
+        var words = query.toLowerCase().match(/[\p{L}\p{N}_]+/gu) || [];
+        var scores = null;
+        for (var i = 0; i < words.length; ++i) {
+            if (words[i].length < minWordLength) {
+                continue;
+            }
+            var found = match(words[i]);
+            if (scores === null) {
+                scores = found;
+            } else {
+                scores.forEach(function (score, id) {
+                    if (found.has(id)) {
+                        scores.set(id, score + found.get(id));
+                    } else {
+                        scores.delete(id);
+                    }
+                });
+            }
+        }
+        if (scores === null) {
+            return [];
+        }
+        return Array.from(scores.keys())
+            .sort(function (a, b) { return scores.get(b) - scores.get(a) || a - b; })
+            .slice(0, maxResults);
+    }
+
+    function show() {
+        var found = search(input.value);
+        results.replaceChildren();
+        for (var i = 0; i < found.length; ++i) {
+            var entry = index.documents[found[i]];
+            var link = document.createElement('a');
+            link.href = entry[0];
+            link.textContent = entry[1];
+            var item = document.createElement('li');
+            item.appendChild(link);
+            results.appendChild(item);
+        }
+    }
+
+    if (form === null) {
+        return;
+    }
+    input.addEventListener('focus', load);
+    input.addEventListener('input', function () { load().then(show); });
+    input.addEventListener('keydown', function (event) {
+        if (event.key === 'Escape') {
+            input.value = '';
+            results.replaceChildren();
+        }
+    });
+    form.addEventListener('submit', function (event) {
+        event.preventDefault();
+        var first = results.querySelector('a');
+        if (first !== null) {
+            window.location.href = first.href;
+        }
+    });
+})();
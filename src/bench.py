@@ -0,0 +1,365 @@
+import argparse as _argparse
+import contextlib as _contextlib
+import io as _io
+import json as _json
+import os as _os
+import shutil as _shutil
+import statistics as _statistics
+import subprocess as _subprocess
+import sys as _sys
+import tempfile as _tempfile
+import time as _time
+
+import build as _build
+import cmark as _cmark
+import content as _content
+import htmltools as _htmltools
+import output as _output
+
+
+baseline_file = f'{_build.build_dir}/bench.json'
+regression_threshold = 1.10
+
+_code_samples = (
+    ('php',
+     '<?php\n\nfunction test_{n}()\n{{\n    $value = compute({n});\n'
+     '    strangetest\\assert_identical({n}, $value);\n}}\n'),
+    ('shell', '$ strangetest tests/test_{n}.php --run=*,{n}\n'),
+    ('json', '{{\n    "autoload": {{\n        "classmap": ["src/{n}"]\n    }}\n}}\n'),
+)
+
+
+def main():
+    parser = _argparse.ArgumentParser(
+        description='Benchmark the documentation build against a synthetic site')
+    parser.add_argument('--pages', type=int, default=50, help='number of pages per section')
+    parser.add_argument('--sections', type=int, default=2, help='number of documentation sections')
+    parser.add_argument('--depth', type=int, default=4, help='depth of the heading hierarchy (at most 5)')
+    parser.add_argument('--fanout', type=int, default=3, help='subheadings per heading')
+    parser.add_argument('--paragraphs', type=int, default=2, help='paragraphs per heading')
+    parser.add_argument('--code-blocks', type=int, default=10, help='code blocks per page')
+    parser.add_argument('--links', type=int, default=20, help='links per page')
+    parser.add_argument('--repeat', type=int, default=5, help='number of times to run each benchmark')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='processes for the end-to-end build')
+    parser.add_argument(
+        '--writers', type=int, default=2, help='writer threads for the output benchmark and the build')
+    parser.add_argument(
+        '--stages', nargs='+', metavar='STAGE', choices=sorted(_stages) + ['output', 'main'],
+        help='only run these benchmarks')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--baseline', default=baseline_file, help='baseline file to compare against')
+    parser.add_argument('--json', metavar='FILE', help='also write the results as JSON to FILE')
+    args = parser.parse_args()
+    assert 1 <= args.depth <= 5, f'Heading depth must be between 1 and 5, not {args.depth}'
+
+    config = {
+        'pages': args.pages,
+        'sections': args.sections,
+        'depth': args.depth,
+        'fanout': args.fanout,
+        'paragraphs': args.paragraphs,
+        'code_blocks': args.code_blocks,
+        'links': args.links,
+        'jobs': args.jobs,
+        'writers': args.writers,
+    }
+    baseline = _os.path.abspath(args.baseline)
+    results = run(config, args.repeat, args.stages)
+    report = {'config': config, 'results': results}
+
+    print_results(report, load_baseline(baseline))
+    if args.json:
+        write_json(args.json, report)
+    if args.save:
+        write_json(baseline, report)
+        print(f'Saved baseline to {baseline}')
+
+
+def run(config, repeat, stages=None):
+    source = _os.path.dirname(_os.path.dirname(_os.path.abspath(__file__)))
+    results = {}
+    cwd = _os.getcwd()
+    saved_registry = _build.registry
+    with _tempfile.TemporaryDirectory() as root:
+        try:
+            _build.registry = generate_site(root, source, config)
+            _os.chdir(root)
+            for name, stage in _stages.items():
+                if stages and name not in stages:
+                    continue
+                results[name] = measure(stage, repeat)
+            if not stages or 'output' in stages:
+                results['output'] = measure(lambda: _stage_output(config['writers']), repeat)
+            if not stages or 'main' in stages:
+                results['main'] = measure(
+                    lambda: _stage_main(config['jobs'], config['writers']), repeat)
+        finally:
+            _os.chdir(cwd)
+            _build.registry = saved_registry
+    return results
+
+
+def measure(stage, repeat):
+    times = []
+    for _ in range(repeat):
+        benchmark = stage()
+        start = _time.perf_counter()
+        benchmark()
+        times.append(_time.perf_counter() - start)
+    result = {'min': min(times), 'median': _statistics.median(times)}
+    return result
+
+
+# Build every page the way a full build does, ready to be rendered.
+def _build_site():
+    site = _build.Site(False)
+    pages = {}
+    _build.build_incremental(site, pages, _build.registry.nav, {}, set())
+    _build.check_urls(site)
+    return site, pages
+
+
+# Render every page and write it to a fresh directory.
+def _stage_output(writers):
+    site, pages = _build_site()
+    _shutil.rmtree('output', ignore_errors=True)
+
+    def benchmark():
+        output = _output.Output('output', 'output-staging', writers=writers)
+        _build.render(output, pages, site.style)
+        output.finish()
+    return benchmark
+
+
+def _stage_main(jobs, writers):
+    def benchmark():
+        argv = _sys.argv
+        _sys.argv = [
+            'build.py', 'dev', '--highlight-cache-size', '0', '--parse-cache-size', '0',
+            '--jobs', str(jobs), '--writers', str(writers),
+        ]
+        try:
+            with _contextlib.redirect_stdout(_io.StringIO()):
+                _build.main()
+        finally:
+            _sys.argv = argv
+    return benchmark
+
+
+
+def generate_site(root, source, config):
+    for directory in ('templates', 'assets'):
+        _shutil.copytree(_os.path.join(source, directory), _os.path.join(root, directory))
+    _os.mkdir(_os.path.join(root, 'content'))
+    _os.mkdir(_os.path.join(root, 'docs'))
+
+    sections = [_content.Section(name='Home', template='page', index='index', pages=())]
+    patterns = {}
+    for s in range(config['sections']):
+        pages = tuple(f'page-{s}-{p}' for p in range(config['pages']))
+        sections.append(_content.Section(
+            name=f'Section {s}', template='documentation', index=f'section-{s}', pages=pages))
+        patterns[f'section-{s}'] = [f'page-{s}-*']
+
+    all_pages = [page for section in sections for page in section.pages]
+    headings = list(generate_headings(config['depth'], config['fanout']))
+    n = 0
+    for section in sections:
+        write_page(root, section.index, [(1, section.name or section.index)], 1, 0, 0, all_pages, [])
+        for page in section.pages:
+            n += 1
+            write_page(
+                root, page, headings, config['paragraphs'], config['code_blocks'],
+                config['links'], all_pages, headings, n)
+
+    # List the pages of each section by pattern, the way a generated
+    # reference would.
+    manifest = [
+        {'name': section.name, 'template': section.template, 'index': section.index,
+         'pages': patterns.get(section.index, [])}
+        for section in sections
+    ]
+    with open(_os.path.join(root, 'content', _content.sections_file), 'w') as fh:
+        _json.dump(manifest, fh)
+    return _content.load(_os.path.join(root, 'content'))
+
+
+def generate_headings(depth, fanout, level=1, number=()):
+    if level == 1:
+        yield 1, 'Overview'
+    if level >= depth:
+        return
+    for i in range(1, fanout + 1):
+        child = number + (i,)
+        yield level + 1, 'Section {}'.format('-'.join(map(str, child)))
+        yield from generate_headings(depth, fanout, level + 1, child)
+
+
+def write_page(root, name, headings, paragraphs, code_blocks, links, pages, targets, seed=0):
+    # Spread the code blocks and links evenly over the page's headings.
+    total = len(headings) * paragraphs
+    out = []
+    k = 0
+    for level, title in headings:
+        out.append(f"{'#' * level} {title}\n")
+        for _ in range(paragraphs):
+            words = [f'Paragraph {k} of *{name}* has some **strong** text and `inline code`']
+            for _ in range(_share(links, total, k)):
+                i = seed + k + len(words)
+                if pages and targets and (i % 3 == 0):
+                    page = pages[i % len(pages)]
+                    target = targets[i % len(targets)][1]
+                    words.append(f'a [cross reference](@{page}#{_htmltools.urlify(target)})')
+                elif targets and (i % 3 == 1):
+                    target = targets[i % len(targets)][1]
+                    words.append(f'a [local reference](@#{_htmltools.urlify(target)})')
+                else:
+                    words.append(f'an [external link](https://example.com/{name}/{i})')
+            out.append(',\n'.join(words) + '.\n')
+
+            for _ in range(_share(code_blocks, total, k)):
+                info, code = _code_samples[(seed + k) % len(_code_samples)]
+                out.append(f'```{info}\n{code.format(n=k)}```\n')
+            k += 1
+
+    with open(_os.path.join(root, 'content', f'{name}.md'), 'w') as fh:
+        fh.write('\n'.join(out))
+
+
+def _share(count, total, k):
+    return (count * (k + 1)) // total - (count * k) // total
+
+
+
+def stage_parse():
+    filenames = [f'content/{page}.md' for _, page, _ in _build.site_pages()]
+    return lambda: [_cmark.parse_events(filename) for filename in filenames]
+
+
+def stage_highlight():
+    blocks = []
+    for _, page, _ in _build.site_pages():
+        events = _cmark.parse_events(f'content/{page}.md')
+        for i, type in enumerate(events.types):
+            if _cmark.NodeType.CODE_BLOCK == type:
+                blocks.append((events.info(i), events.literal(i)))
+
+    def benchmark():
+        for info, code in blocks:
+            if 'php' == info:
+                _build.highlight_php(code)
+            elif 'json' == info:
+                _build.highlight_json(code)
+            else:
+                _build.highlight_shell(code)
+    return benchmark
+
+
+def stage_build_article():
+    def benchmark():
+        site = _build.Site(False)
+        nav = _build.registry.nav
+        _build.build_pages(site, nav, _build.site_pages())
+    return benchmark
+
+
+def stage_build_toc():
+    site = _build.Site(False)
+    nav = _build.registry.nav
+    built = _build.build_pages(site, nav, _build.site_pages())
+
+    def benchmark():
+        for section in _build.registry.sections:
+            if not section.pages:
+                continue
+            toc = _build.TocEntries()
+            tocs = []
+            for page, _ in _content.section_pages(section):
+                template, headings = built[page]
+                tocs.append(_build.build_toc_entries(toc, page, template.heading_level, headings))
+            for entries in tocs:
+                _build.build_toc(entries)
+    return benchmark
+
+
+def stage_render_template():
+    site, pages = _build_site()
+    for template in pages.values():
+        _build.prepare_page(template, site.style)
+
+    def benchmark():
+        for template in pages.values():
+            _htmltools.render_template(template.doc, template.placeholder)
+    return benchmark
+
+
+# Templates are small, so each is parsed many times to get a stable number.
+def stage_build_template():
+    filenames = sorted(_os.path.join('templates', name) for name in _os.listdir('templates'))
+
+    def benchmark():
+        for _ in range(100):
+            for filename in filenames:
+                _htmltools.build_template(filename)
+    return benchmark
+
+
+# Start a new interpreter for a command that does no work, which is all
+# import time.
+def stage_startup():
+    command = [_sys.executable, _build.__file__, '--help']
+    return lambda: _subprocess.run(command, check=True, stdout=_subprocess.DEVNULL)
+
+
+def stage_css():
+    site = _build.Site(False)
+    nav = _build.registry.nav
+    _build.build_pages(site, nav, _build.site_pages())
+    return lambda: _build.build_style(site)
+
+
+_stages = {
+    'parse': stage_parse,
+    'highlight': stage_highlight,
+    'build_article': stage_build_article,
+    'build_toc': stage_build_toc,
+    'render_template': stage_render_template,
+    'build_template': stage_build_template,
+    'css': stage_css,
+    'startup': stage_startup,
+}
+
+
+
+def load_baseline(filename):
+    try:
+        with open(filename, 'r') as fh:
+            return _json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(filename, report):
+    _os.makedirs(_os.path.dirname(_os.path.abspath(filename)), exist_ok=True)
+    with open(filename, 'w') as fh:
+        _json.dump(report, fh, indent=2, sort_keys=True)
+
+
+def print_results(report, baseline):
+    if baseline and baseline['config'] != report['config']:
+        print('Baseline was recorded with a different configuration, not comparing')
+        baseline = None
+
+    print(f"{'benchmark':<16} {'min ms':>10} {'median ms':>10} {'baseline':>10} {'change':>8}")
+    for name, result in report['results'].items():
+        line = '{:<16} {:>10.2f} {:>10.2f}'.format(name, result['min'] * 1000, result['median'] * 1000)
+        if baseline and name in baseline['results']:
+            before = baseline['results'][name]['min']
+            ratio = result['min'] / before
+            flag = '  slower' if ratio > regression_threshold else ''
+            line += ' {:>10.2f} {:>+7.0%}{}'.format(before * 1000, ratio - 1, flag)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
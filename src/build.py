@@ -1,62 +1,63 @@
+import argparse as _argparse
 import collections as _collections
+import concurrent.futures as _futures
+import hashlib as _hashlib
 import http as _http
+import itertools as _itertools
+import json as _json
+import marshal as _marshal
 import os as _os
-import shutil as _shutil
+import re as _re
 import sys as _sys
-#import urllib.error.HTTPError as _HTTPError
-import urllib.request as _urlrequest
 
 import cmark as _cmark
+import content as _content
 import htmltools as _htmltools
+import output as _output
+import profiling as _profiling
+import search as _search
+import urlcheck as _urlcheck
 
-from pygments import highlight
-from pygments.lexers import BashSessionLexer, JsonLexer, PhpLexer
-from pygments.formatters import HtmlFormatter
-
-
-Section = _collections.namedtuple('Section', ('name', 'template', 'index', 'pages'))
-
-sections = (
-    Section(
-        name = 'Home',
-        template = 'page',
-        index = 'index',
-        pages = (),
-    ),
-    Section(
-        name = 'Documentation',
-        template = 'documentation',
-        index = 'documentation',
-        pages = (
-            'getting-started',
-            'running-tests',
-            'writing-tests',
-            'test-fixtures',
-            'assertions',
-        ),
-    ),
-    Section(
-        name = 'Contributing',
-        template = 'page',
-        index = 'contributing',
-        pages = (),
-    ),
-    Section(
-        name = None,
-        template = 'page',
-        index = 'sample-code',
-        pages = (),
-    ),
-)
+import pygments as _pygments
+from pygments.token import STANDARD_TYPES
+
+
+build_dir = 'build'
+manifest_file = f'{build_dir}/manifest.json'
+url_cache_file = f'{build_dir}/urls.json'
+highlight_cache_dir = f'{build_dir}/highlight'
+parse_cache_dir = f'{build_dir}/parse'
+template_cache_dir = f'{build_dir}/templates'
+search_dir = f'{build_dir}/search'
+staging_dir = f'{build_dir}/staging'
+manifest_version = 3
 
 
 class Site:
-    __slots__ = 'index', 'urls', 'remote_urls'
+    __slots__ = 'index', 'urls', 'remote_urls', 'links', 'tokens', 'style', 'checker'
 
-    def __init__(self, remote_urls):
+    def __init__(self, remote_urls, checker=None):
         self.index = {}
         self.urls = []
         self.remote_urls = remote_urls
+        self.links = {}
+        self.tokens = {}
+        self.style = None
+        self.checker = checker
+
+
+class PageResult:
+    __slots__ = 'article', 'headings', 'urls', 'links', 'tokens', 'cached', 'highlights', 'profile'
+
+    def __init__(self, article, headings, urls, links, tokens, cached, highlights, profile):
+        self.article = article
+        self.headings = headings
+        self.urls = urls
+        self.links = links
+        self.tokens = tokens
+        self.cached = cached
+        self.highlights = highlights
+        self.profile = profile
 
 
 class Link:
@@ -70,70 +71,288 @@ class Link:
 
 
 def main():
-    remote_urls = False
-    if len(_sys.argv) > 1:
-        mode = _sys.argv[1]
-        if 'dev' == mode:
-            remote_urls = False
-        elif 'release' == mode:
-            remote_urls = True
-        else:
-            raise Error(f"Unknown release mode: {mode}")
-
-    site = Site(remote_urls)
-    nav = {}
+    parser = _argparse.ArgumentParser()
+    parser.add_argument('mode', nargs='?', default='dev', choices=('dev', 'release', 'serve'))
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='only rebuild pages whose inputs changed since the last build')
+    parser.add_argument(
+        '--link-workers', type=int, default=8, metavar='N',
+        help='number of external links to check concurrently')
+    parser.add_argument(
+        '--link-timeout', type=float, default=10, metavar='SECONDS',
+        help='timeout for checking an external link')
+    parser.add_argument(
+        '--link-ttl', type=float, default=24, metavar='HOURS',
+        help='how long a successfully checked external link is trusted')
+    parser.add_argument(
+        '--recheck-links', action='store_true',
+        help='ignore previously cached link check results')
+    parser.add_argument(
+        '--highlight-cache-size', type=float, default=64, metavar='MB',
+        help='maximum size of the code highlighting cache (0 disables it)')
+    parser.add_argument(
+        '--parse-cache-size', type=float, default=64, metavar='MB',
+        help='maximum size of the cache of parsed pages (0 disables it)')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, metavar='N',
+        help='number of processes to build pages with')
+    parser.add_argument(
+        '--port', type=int, default=8000,
+        help='port for serve mode to listen on')
+    parser.add_argument(
+        '--live-reload', action='store_true',
+        help='in serve mode, reload pages in the browser when they are rebuilt')
+    parser.add_argument(
+        '--minify', action=_argparse.BooleanOptionalAction,
+        help='leave out optional end tags, quotes and whitespace (the default for release builds)')
+    parser.add_argument(
+        '--compress', action='store_true',
+        help='write gzip (and brotli, if installed) compressed copies of every page and stylesheet')
+    parser.add_argument(
+        '--writers', type=int, default=2, metavar='N',
+        help='number of threads that write pages while the rest of them is rendered (0 writes them in turn)')
+    parser.add_argument(
+        '--fsync', action='store_true',
+        help='make sure every written file is on disk before it replaces the old one')
+    parser.add_argument(
+        '--native-html', action='store_true',
+        help='let libcmark render paragraphs and lists that need no special handling')
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='print how long each phase of the build took')
+    parser.add_argument(
+        '--profile-json', metavar='FILE',
+        help='also write the profile as JSON to FILE')
+    args = parser.parse_args()
+
+    global highlight_cache, parse_cache, profile, minify, native_html, registry
+    registry = _content.load('content')
+    minify = args.minify if args.minify is not None else ('release' == args.mode)
+    native_html = args.native_html
+    if args.profile or args.profile_json:
+        profile = _profiling.Profile()
+    if args.highlight_cache_size > 0:
+        highlight_cache = HighlightCache(
+            highlight_cache_dir, int(args.highlight_cache_size * 1024 * 1024))
+    if args.parse_cache_size > 0:
+        parse_cache = ParseCache(parse_cache_dir, int(args.parse_cache_size * 1024 * 1024))
+
+    cache = _urlcheck.Cache(url_cache_file, args.link_ttl * 60 * 60, args.recheck_links)
+    checker = _urlcheck.Checker(
+        workers=args.link_workers, timeout=args.link_timeout, cache=cache)
+    site = Site('release' == args.mode, checker)
+    nav = registry.nav
     pages = {}
-    for section in sections:
-        if section.name:
-            nav[section.name] = section.index
-        build_section(site, pages, section, nav)
-    check_urls(site)
-    render(pages)
+    pool = None
+    if args.jobs > 1:
+        caches = [
+            (cache.directory, cache.max_size) if cache is not None else None
+            for cache in (highlight_cache, parse_cache)
+        ]
+        pool = _futures.ProcessPoolExecutor(
+            args.jobs, initializer=init_worker, initargs=(*caches, bool(profile), native_html))
+    try:
+        if 'serve' == args.mode:
+            serve(args.port, args.live_reload, pool)
+            return
+        # A full build is an incremental one that starts without a manifest,
+        # so that it leaves one for the next incremental build.
+        manifest = {}
+        if args.incremental:
+            with profile.timer('manifest'):
+                manifest = load_manifest(args.mode)
+        with profile.timer('incremental'):
+            entries = build_incremental(site, pages, nav, manifest, unchanged_pages(manifest), pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    with profile.timer('check_urls'):
+        check_urls(site)
+    output = _output.Output(
+        'docs', staging_dir, keep=('CNAME',), compress=args.compress, writers=args.writers,
+        fsync=args.fsync)
+    render(output, pages, site.style, entries)
+    if args.incremental:
+        print(f'Rebuilt {len(pages)} of {len(entries)} pages')
+
+    output.write(site.style.filename, site.style.css)
+    with profile.timer('search'):
+        output.write('search.json', build_search_index())
+    output.write('search.js', read_asset('search.js'))
+    with profile.timer('output'):
+        report = output.finish()
+    profile.count('bytes written', report.size)
+    print(f'Wrote docs: {report}')
+    with profile.timer('manifest'):
+        for page, entry in entries.items():
+            if page in pages:
+                entry['output'] = output.digests[f'{page}.html']
+            else:
+                entry['output'] = manifest[page]['output']
+        save_manifest(args.mode, entries)
+
+    if highlight_cache is not None:
+        highlight_cache.trim()
+        total = highlight_cache.hits + highlight_cache.misses
+        if total:
+            print('Highlighted {} code blocks ({} cached, {:.0%} hit rate)'.format(
+                total, highlight_cache.hits, highlight_cache.hits / total))
+    if parse_cache is not None:
+        parse_cache.trim()
+        total = parse_cache.hits + parse_cache.misses
+        if total:
+            print('Parsed {} pages ({} cached)'.format(total, parse_cache.hits))
+
+    if profile:
+        print(profile.summary())
+        if args.profile_json:
+            profile.write(args.profile_json)
 
+
+def build_search_index():
+    return _search.build_index(search_dir, [page for _, page, _ in site_pages()])
+
+
+def read_asset(filename):
+    with open(f'assets/{filename}') as fh:
+        return fh.read()
+
+
+def build_style(site):
     with open('assets/style.css') as fh:
         style = fh.read();
-    highlights = formatter.get_style_defs('div.highlight > pre')
-    with open('docs/style.css', 'w') as fh:
-        fh.write(highlights)
-        fh.write("\n\n\n")
-        fh.write(style)
+    tokens = set().union(*site.tokens.values())
+    highlights = get_formatter().get_style_defs(highlight_selector).splitlines()
+    highlights = '\n'.join(rule for rule in highlights if keep_highlight_rule(rule, tokens))
+    css = f'{highlights}\n\n\n{style}'
+    if minify:
+        css = minify_css(css)
+
+    digest = _hashlib.sha256(css.encode('utf-8')).hexdigest()
+    filename = f'style.{digest[:16]}.css'
+    link = _htmltools.Html(set())
+    element = _htmltools.add_element(link, 'link')
+    _htmltools.set_attribute(element, 'rel', 'stylesheet')
+    _htmltools.set_attribute(element, 'href', filename)
+    return Stylesheet(filename, css, link)
+
+
+def keep_highlight_rule(rule, tokens):
+    match = _highlight_rule.match(rule)
+    if match and (match.group(1) in _token_classes):
+        return match.group(1) in tokens
+    return True
+
+
+def minify_css(css):
+    css = _css_comments.sub(lambda match: match.group(1) or '', css)
+    css = _css_whitespace.sub(_minify_css_token, css)
+    return css.strip()
+
+
+def _minify_css_token(match):
+    string, end, punctuation, colon = match.groups()
+    if string:
+        return string
+    elif end:
+        return '}'
+    elif punctuation:
+        return punctuation
+    elif colon:
+        return ':'
+    else:
+        return ' '
+
+
+highlight_selector = 'div.highlight > pre'
+_highlight_rule = _re.compile(_re.escape(highlight_selector) + r' \.([\w-]+) ')
+_token_classes = frozenset(STANDARD_TYPES.values())
+_css_string = r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')'''
+_css_comments = _re.compile(_css_string + r'|/\*.*?\*/', _re.DOTALL)
+_css_whitespace = _re.compile(_css_string + r'|(\s*;?\s*}\s*)|\s*([{;,>])\s*|(:)\s+|\s+')
+
+
+def serve(port, live_reload, pool=None):
+    # http.server takes longer to import than everything else a build needs.
+    import devserver as _devserver
+
+    manifest = {}
+
+    def rebuild(outputs, changed):
+        nonlocal manifest
+        # Drop the parsed copy of any template that changed on disk.
+        for path in changed:
+            name, ext = _os.path.splitext(_os.path.basename(path))
+            if ('.html' == ext) and (_os.path.basename(_os.path.dirname(path)) == 'templates'):
+                _templates.pop(name, None)
+
+        site = Site(False)
+        global registry
+        registry = _content.load('content')
+        nav = registry.nav
+        pages = {}
+        existing = {page for page in manifest if f'{page}.html' in outputs}
+        entries = build_incremental(site, pages, nav, manifest, existing, pool)
+        check_urls(site)
+
+        for filename in list(outputs):
+            name, ext = _os.path.splitext(filename)
+            if (('.html' == ext) and (name not in entries)
+                    or ('.css' == ext) and (filename != site.style.filename)):
+                del outputs[filename]
+        for name, template in pages.items():
+            outputs[f'{name}.html'] = render_page(template, site.style)
+        outputs[site.style.filename] = site.style.css
+        outputs['search.json'] = build_search_index()
+        outputs['search.js'] = read_asset('search.js')
+        manifest = entries
+        return len(pages)
+
+    server = _devserver.Server(
+        ('127.0.0.1', port), ('content', 'templates', 'assets'), rebuild, live_reload)
+    server.serve_forever()
 
 
 class Template:
     __slots__ = 'ids', 'doc', 'placeholder', 'heading_level'
 
     def __init__(self, base):
-        self.ids = set(base.ids)
+        self.ids = _htmltools.IdSet(base.ids)
         self.heading_level = base.heading_level
         self.placeholder = Placeholders(base.placeholders)
         self.doc = base
 
 
+# Only the placeholders that have been set are stored: the names are shared
+# with the template, and every other placeholder is None.
 class Placeholders:
     def __init__(self, placeholders):
-        placeholders = {placeholder: None for placeholder in placeholders}
-        object.__setattr__(self, '_placeholders', placeholders)
+        object.__setattr__(self, '_names', placeholders)
+        object.__setattr__(self, '_values', {})
 
     def __getattr__(self, name):
-        if name in self._placeholders:
-            return self._placeholders[name]
+        if name in self._names:
+            return self._values.get(name)
         else:
             raise AttributeError(
                 f"'{self.__class__.__name__}' object has no attribute '{name}'")
 
     def __setattr__(self, name, value):
-        if name in self._placeholders:
-            self._placeholders[name] = value
+        if name in self._names:
+            self._values[name] = value
         else:
             raise AttributeError(
                 f"'{self.__class__.__name__}' object has no attribute '{name}'")
 
 
 NavBar = _collections.namedtuple('NavBar', ('sections', 'current'))
+Stylesheet = _collections.namedtuple('Stylesheet', ('filename', 'css', 'link'))
 
 class TableOfContents:
 
     def __init__(self, toc, section, heading_level):
+        self.root = toc
         self.toc = toc
         self.section = section
         self.heading_level = heading_level
@@ -141,6 +360,72 @@ class TableOfContents:
         self.stack = []
 
 
+# The top-level entries of the table of contents of a section, which every
+# page in the section shares, and their TocFragments once it's rendered.
+class TocEntries(list):
+    __slots__ = 'fragments',
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.fragments = None
+
+
+
+# A table of contents rendered once for all pages of a section. Whether
+# build_toc_html checks a collapsible entry depends on the entries before it,
+# so each entry is rendered for each state that build_toc_html can be in when
+# it gets to an entry that isn't the page's own: before the page's entry
+# (False) and after it (_nested). A page then only needs to render its own
+# entry and splice it in between the others.
+class TocFragments:
+    __slots__ = 'entries', 'pages', 'headings', 'others', 'offsets'
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.pages = {}
+        self.headings = {}
+        self.others = {}
+        self.offsets = {}
+        for i, entry in enumerate(entries):
+            self.pages[entry.url] = i
+            for url in subheading_urls(entry):
+                self.headings.setdefault(url, []).append(i)
+        for state in (False, _nested):
+            others = [render_toc_entry(entry, None, state)[0] for entry in entries]
+            self.others[state] = ''.join(others)
+            self.offsets[state] = list(_itertools.accumulate(map(len, others), initial=0))
+
+
+    def render(self, page):
+        # build_toc_html treats a subheading whose id is the name of the page
+        # like the page's own entry, so an entry with such a subheading has
+        # to be rendered for this page as well.
+        special = set(self.headings.get(page, ()))
+        if page in self.pages:
+            special.add(self.pages[page])
+
+        parts = ['<ol>']
+        state = False
+        i = 0
+        for end in (*sorted(special), len(self.entries)):
+            while i < end:
+                if state is True:
+                    html, state = render_toc_entry(self.entries[i], page, state)
+                    parts.append(html)
+                    i += 1
+                else:
+                    offsets = self.offsets[state]
+                    parts.append(self.others[state][offsets[i]:offsets[end]])
+                    i = end
+            if i < len(self.entries):
+                html, state = render_toc_entry(self.entries[i], page, state)
+                parts.append(html)
+                i += 1
+        parts.append('</ol>')
+        return ''.join(parts)
+
+
+
 class Heading:
 
     def __init__(self, url, name=None):
@@ -152,27 +437,284 @@ class Heading:
         return f'Heading({self.name})'
 
 
-json_lexer = JsonLexer()
-php_lexer = PhpLexer(startinline=True)
-shell_lexer = BashSessionLexer()
-formatter = HtmlFormatter(style='algol_nu', wrapcode=True)
+# Importing lexers and creating them takes a good part of starting up, and
+# with a warm highlight cache a build may not need them at all, so they're
+# only created for the first code block that has to be highlighted. Cache
+# keys only need their names and options.
+class Lexer:
+    __slots__ = 'name', 'options', '_lexer'
+
+    def __init__(self, name, **options):
+        self.name = name
+        self.options = options
+        self._lexer = None
+
+
+    def get(self):
+        if self._lexer is None:
+            from pygments import lexers
+            self._lexer = getattr(lexers, self.name)(**self.options)
+        return self._lexer
+
 
-highlight_php = lambda code: highlight(code, php_lexer, formatter)
-highlight_shell = lambda code: highlight(code, shell_lexer, formatter)
-highlight_json = lambda code: highlight(code, json_lexer, formatter)
 
+json_lexer = Lexer('JsonLexer')
+php_lexer = Lexer('PhpLexer', startinline=True)
+shell_lexer = Lexer('BashSessionLexer')
+formatter_options = {'style': 'algol_nu', 'wrapcode': True}
 
+highlight_php = lambda code: highlight_code(code, php_lexer)
+highlight_shell = lambda code: highlight_code(code, shell_lexer)
+highlight_json = lambda code: highlight_code(code, json_lexer)
+
+
+registry = None
+highlight_cache = None
+parse_cache = None
+profile = _profiling.NullProfile()
+worker = False
+minify = False
+native_html = False
+
+def highlight_code(code, lexer):
+    profile.count('code blocks')
+    with profile.timer('highlight'):
+        if highlight_cache is None:
+            return _pygments.highlight(code, lexer.get(), get_formatter())
+        else:
+            return highlight_cache.highlight(code, lexer)
+
+
+def get_formatter():
+    global _formatter
+    if _formatter is None:
+        from pygments.formatters import HtmlFormatter
+        _formatter = HtmlFormatter(**formatter_options)
+    return _formatter
+
+
+_formatter = None
+
+
+# Highlighted code is kept on disk and, for later builds in the same process
+# such as the dev server's, in memory. Both are limited to max_size (bytes on
+# disk, characters in memory) by dropping what was used least recently.
+class HighlightCache:
+    __slots__ = 'directory', 'max_size', 'hits', 'misses', 'memory', 'memory_size'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.memory = _collections.OrderedDict()
+        self.memory_size = 0
+
+
+    def highlight(self, code, lexer):
+        key = hash_json([
+            lexer.name,
+            repr(sorted(lexer.options.items())),
+            repr(sorted(formatter_options.items())),
+            _pygments.__version__,
+            _hashlib.sha256(code.encode('utf-8')).hexdigest(),
+        ])
+        if key in self.memory:
+            self.hits += 1
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        filename = f'{self.directory}/{key[:2]}/{key}.html'
+        try:
+            with open(filename, 'r') as fh:
+                result = fh.read()
+        except OSError:
+            pass
+        else:
+            self.hits += 1
+            self.remember(key, result)
+            _os.utime(filename)
+            return result
+
+        self.misses += 1
+        result = _pygments.highlight(code, lexer.get(), get_formatter())
+        self.remember(key, result)
+        _os.makedirs(_os.path.dirname(filename), exist_ok=True)
+        with open(f'{filename}.{_os.getpid()}.tmp', 'w') as fh:
+            fh.write(result)
+        _os.replace(f'{filename}.{_os.getpid()}.tmp', filename)
+        return result
+
+
+    def remember(self, key, result):
+        self.memory[key] = result
+        self.memory_size += len(result)
+        while self.memory_size > self.max_size:
+            _, dropped = self.memory.popitem(last=False)
+            self.memory_size -= len(dropped)
+
+
+    def trim(self):
+        trim_cache(self.directory, self.max_size)
+
+
+
+# Caches what build_article makes of a page: the article, its headings, ids
+# and links, and the highlight classes it uses. Entries are marshalled
+# tuples of plain values behind a short header; marshal's format depends on
+# the Python version, which is part of the key.
+class ParseCache:
+    __slots__ = 'directory', 'max_size', 'hits', 'misses'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+
+    def load(self, key, site, template, source):
+        filename = f'{self.directory}/{key[:2]}/{key}.bin'
+        try:
+            with open(filename, 'rb') as fh:
+                data = fh.read()
+        except OSError:
+            return None
+        if not data.startswith(_parse_cache_header):
+            return None
+        article, ids, headings, urls, links, tokens = _marshal.loads(
+            memoryview(data)[len(_parse_cache_header):])
+        if not template.ids.isdisjoint(ids):
+            # The template has gained an id that the page also uses, so
+            # let build_article report it.
+            return None
+
+        template.ids.update(ids)
+        article = _htmltools.load_html(template.ids, article)
+        template.placeholder.article = article
+        for index, line, url in urls:
+            site.urls.append(Link(source, line, url, _htmltools.element_at(article, index)))
+        site.links[source] = set(links)
+        site.tokens[source] = set(tokens)
+        self.hits += 1
+        _os.utime(filename)
+        return headings
+
+
+    def save(self, key, site, template, source, headings):
+        data = (
+            _htmltools.dump_html(template.placeholder.article),
+            sorted(template.ids.added),
+            headings,
+            [(_htmltools.element_index(link.element), link.line, link.url) for link in site.urls],
+            sorted(site.links[source]),
+            sorted(site.tokens[source]),
+        )
+
+        self.misses += 1
+        filename = f'{self.directory}/{key[:2]}/{key}.bin'
+        _os.makedirs(_os.path.dirname(filename), exist_ok=True)
+        with open(f'{filename}.{_os.getpid()}.tmp', 'wb') as fh:
+            fh.write(_parse_cache_header)
+            fh.write(_marshal.dumps(data))
+        _os.replace(f'{filename}.{_os.getpid()}.tmp', filename)
+
+
+    def trim(self):
+        trim_cache(self.directory, self.max_size)
+
+
+_parse_cache_header = b'PARSE\x02'
+
+
+# The key of everything that goes into a page's article, which is what the
+# parse cache and the search index store it under.
+def page_key(source, template, include_in_toc):
+    global _page_tool
+    if _page_tool is None:
+        _page_tool = hash_json([
+            hash_tool(),
+            repr(sorted(formatter_options.items())),
+            _pygments.__version__,
+            _sys.version,
+            _marshal.version,
+        ])
+    result = hash_json([
+        hash_file(f'content/{source}.md'),
+        template.heading_level,
+        include_in_toc,
+        native_html,
+        _page_tool,
+    ])
+    return result
+
+
+_page_tool = None
+
+
+def trim_cache(directory, max_size):
+    entries = []
+    size = 0
+    for dirpath, _, filenames in _os.walk(directory):
+        for name in filenames:
+            path = _os.path.join(dirpath, name)
+            stat = _os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+            size += stat.st_size
+
+    entries.sort()
+    for _, entry_size, path in entries:
+        if size <= max_size:
+            break
+        _os.remove(path)
+        size -= entry_size
+
+
+# The loaded templates by name, as (digest of the file, template). Given a
+# digest, get_template loads the template again if it doesn't match, which
+# is how pool workers learn that a template changed.
 _templates = {}
 
-def get_template(basename):
-    if basename not in _templates:
-        _templates[basename] = _htmltools.build_template(f'templates/{basename}.html')
+def get_template(basename, digest=None):
+    cached = _templates.get(basename)
+    if (cached is None) or ((digest is not None) and (digest != cached[0])):
+        cached = _templates[basename] = load_template(basename)
 
-    base = _templates[basename]
+    base = cached[1]
     template = Template(base)
     return template
 
 
+# Templates are compiled once and kept in the build directory, so that only
+# a template that changed needs to be parsed again. Returns the digest of the
+# template file along with the template.
+def load_template(basename):
+    filename = f'templates/{basename}.html'
+    cached = f'{template_cache_dir}/{basename}.bin'
+    digest = hash_file(filename)
+    key = hash_json([digest, hash_tool(), _sys.version, _marshal.version])
+    try:
+        with open(cached, 'rb') as fh:
+            data = fh.read()
+    except OSError:
+        data = b''
+    if data.startswith(_template_cache_header):
+        stored, template = _marshal.loads(memoryview(data)[len(_template_cache_header):])
+        if stored == key:
+            return digest, _htmltools.load_template(template)
+
+    result = _htmltools.build_template(filename)
+    _os.makedirs(template_cache_dir, exist_ok=True)
+    with open(f'{cached}.{_os.getpid()}.tmp', 'wb') as fh:
+        fh.write(_template_cache_header)
+        fh.write(_marshal.dumps((key, _htmltools.dump_template(result))))
+    _os.replace(f'{cached}.{_os.getpid()}.tmp', cached)
+    return digest, result
+
+
+_template_cache_header = b'TEMPLATE\x01'
+
+
 _nodes = {
     _cmark.NodeType.EMPH: 'em',
     _cmark.NodeType.ITEM: 'li',
@@ -181,56 +723,141 @@ _nodes = {
 }
 
 
-def build_section(site, pages, section, nav):
-    toc = [] if section.pages else None
-    page = section.index
-    pages[page] = build_page(site, section, page, nav, toc, False)
-    for page in section.pages:
-        pages[page] = build_page(site, section, page, nav, toc, True)
+def site_pages():
+    for page in registry:
+        yield page.section, page.name, page.include_in_toc
 
 
+def build_pages(site, nav, jobs, pool=None):
+    jobs = list(jobs)
+    templates = [section.template for section, _, _ in jobs]
+    names = [page for _, page, _ in jobs]
+    include_in_toc = [include for _, _, include in jobs]
+    digests = {template: hash_file(f'templates/{template}.html') for template in set(templates)}
+    digests = [digests[template] for template in templates]
+    if pool is None:
+        results = map(parse_page, templates, names, include_in_toc, digests)
+    else:
+        results = pool.map(parse_page, templates, names, include_in_toc, digests)
+
+    built = {}
+    for (section, name, _), result in zip(jobs, results):
+        built[name] = merge_page(site, section, name, nav, result)
+        if (pool is not None) and (highlight_cache is not None):
+            hits, misses = result.highlights
+            highlight_cache.hits += hits
+            highlight_cache.misses += misses
+        if (pool is not None) and (parse_cache is not None):
+            if result.cached:
+                parse_cache.hits += 1
+            else:
+                parse_cache.misses += 1
+    return built
+
+
+def parse_page(template, name, include_in_toc, digest=None):
+    global profile
+    if worker and profile:
+        profile = _profiling.Profile()
+    if highlight_cache is not None:
+        hits, misses = highlight_cache.hits, highlight_cache.misses
+
+    with profile.timer('template', name):
+        page = get_template(template, digest)
+    site = Site(False)
+    headings = None
+    key = page_key(name, page, include_in_toc)
+    if parse_cache is not None:
+        with profile.timer('parse_cache', name):
+            headings = parse_cache.load(key, site, page, name)
+    cached = headings is not None
+    if not cached:
+        with profile.timer('article', name):
+            headings = build_article(site, page, name, include_in_toc)
+        if parse_cache is not None:
+            with profile.timer('parse_cache', name):
+                parse_cache.save(key, site, page, name, headings)
+    if not _search.has_page(search_dir, name, key):
+        with profile.timer('search', name):
+            sections = _search.page_sections(page.placeholder.article, headings)
+            _search.save_page(search_dir, name, key, sections)
+
+    if highlight_cache is not None:
+        highlights = (highlight_cache.hits - hits, highlight_cache.misses - misses)
+    else:
+        highlights = (0, 0)
+    return PageResult(
+        page.placeholder.article, headings, site.urls, site.links[name], site.tokens[name], cached,
+        highlights, profile.data() if worker else None)
+
 
-def build_page(site, section, name, nav, toc, include_in_toc):
+def merge_page(site, section, name, nav, result):
     assert name not in site.index, f"Page {name} exists multiple times?!"
-    site.index[name] = set()
 
     page = get_template(section.template)
+    page.ids = result.article.ids
+    page.placeholder.article = result.article
     page.placeholder.navbar = NavBar(nav, section.index)
-    if toc is not None:
-        page.placeholder.toc = TableOfContents(toc, name, page.heading_level + 1)
-    build_article(site, page, name, include_in_toc)
-    return page
-
-
-def set_toc(document, toc, current):
-    document.placeholder.toc = TableOfContents(toc, current, document.heading_level + 1)
+    site.index[name] = {id for _, _, id in result.headings}
+    site.urls.extend(result.urls)
+    site.links[name] = result.links
+    site.tokens[name] = result.tokens
+    if result.profile is not None:
+        profile.merge(result.profile)
+    return page, result.headings
+
+
+def init_worker(highlights, parses, profiled, native):
+    global highlight_cache, parse_cache, profile, worker, native_html
+    worker = True
+    native_html = native
+    if highlights is not None:
+        highlight_cache = HighlightCache(*highlights)
+    if parses is not None:
+        parse_cache = ParseCache(*parses)
+    if profiled:
+        profile = _profiling.Profile()
+
+
+def build_toc_entries(toc, page, heading_level, headings):
+    result = TableOfContents(toc, page, heading_level + 1)
+    for level, name, id in headings:
+        add_toc_entry(result, level, name, id)
+    return result
 
 
 def build_article(site, template, source, include_in_toc):
-    article = _htmltools.Html(template.ids)
+    article = _htmltools.CompactHtml(template.ids)
     template.placeholder.article = article
+    site.links[source] = set()
+    site.tokens[source] = set()
 
-    ast = _cmark.parse_document(f'content/{source}.md')
+    with profile.timer('parse'):
+        events = _cmark.parse_events(f'content/{source}.md', native_html)
+    profile.count('nodes', len(events))
+    types = events.types
     parent = article
     stack = []
+    headings = []
     heading_offset = template.heading_level
     heading = {'level': 0} if include_in_toc else None
-    for event, node in ast:
+    for i, event in enumerate(events.events):
+        node_type = types[i]
         if _cmark.EventType.ENTER == event:
             child = None
-            if _cmark.NodeType.DOCUMENT == node.type:
+            if _cmark.NodeType.DOCUMENT == node_type:
                 pass
 
-            elif _cmark.NodeType.LIST == node.type:
-                list_type = node.list_type
+            elif _cmark.NodeType.LIST == node_type:
+                list_type = events.values[i]
                 if _cmark.ListType.BULLET_LIST == list_type:
                     child = _htmltools.add_element(parent, 'ul')
                 else:
                     assert _cmark.ListType.ORDERED_LIST == list_type, f'Unexpected list type: {list_type}'
                     child = _htmltools.add_element(parent, 'ol')
 
-            elif _cmark.NodeType.HEADING == node.type:
-                level = node.heading_level + heading_offset
+            elif _cmark.NodeType.HEADING == node_type:
+                level = events.values[i] + heading_offset
                 child = _htmltools.add_element(parent, f'h{level}')
                 if heading is not None:
                     assert \
@@ -239,27 +866,33 @@ def build_article(site, template, source, include_in_toc):
                     heading['level'] = level
                     heading['element'] = child
 
-            elif _cmark.NodeType.LINK == node.type:
+            elif _cmark.NodeType.LINK == node_type:
                 child = _htmltools.add_element(parent, 'a')
-                site.urls.append(Link(source, node.start_line, node.url, child))
+                url = events.url(i)
+                site.urls.append(Link(source, events.lines[i], url, child))
+                if url.startswith('@'):
+                    site.links[source].add(link_target(source, url))
 
-            elif _cmark.NodeType.TEXT == node.type:
-                literal = node.literal
+            elif _cmark.NodeType.TEXT == node_type:
+                literal = events.literal(i)
                 _htmltools.add_text(parent, literal, False)
                 if heading and heading['level']:
                     heading['name'] = literal
                     heading['id'] = _htmltools.urlify(literal)
                     _htmltools.set_attribute(heading['element'], 'id', heading['id'])
 
-            elif _cmark.NodeType.SOFTBREAK == node.type:
+            elif _cmark.NodeType.SOFTBREAK == node_type:
                 _htmltools.add_text(parent, ' ', False)
 
-            elif _cmark.NodeType.CODE == node.type:
-                _htmltools.add_text(_htmltools.add_element(parent, 'code'), node.literal)
+            elif _cmark.NodeType.CODE == node_type:
+                _htmltools.add_text(_htmltools.add_element(parent, 'code'), events.literal(i))
+
+            elif _cmark.NATIVE_HTML == node_type:
+                _htmltools.add_html(parent, adapt_native_html(events.literal(i)))
 
-            elif _cmark.NodeType.CODE_BLOCK == node.type:
-                code = node.literal
-                info = node.info
+            elif _cmark.NodeType.CODE_BLOCK == node_type:
+                code = events.literal(i)
+                info = events.info(i)
                 if 'php' == info:
                     code = highlight_php(code)
                 elif 'shell' == info:
@@ -270,28 +903,61 @@ def build_article(site, template, source, include_in_toc):
                     assert '' == info, f'Unknown code block type: {info}'
                     code = highlight_shell(code)
                 _htmltools.add_html(parent, code)
+                site.tokens[source].update(token_classes(code))
 
             else:
-                assert node.type in _nodes, \
-                    f'Unhandled {_cmark.NodeType._fields[node.type]} in {source}.md:{node.start_line}'
-                child = _htmltools.add_element(parent, _nodes[node.type])
+                assert node_type in _nodes, \
+                    f'Unhandled {_cmark.NodeType._fields[node_type]} in {source}.md:{events.lines[i]}'
+                child = _htmltools.add_element(parent, _nodes[node_type])
 
-            if child and child.content is not None:
+            if child is not None:
                 stack.append(parent)
                 parent = child
 
         else:
             assert _cmark.EventType.EXIT == event, f'Unexpected event: {event}'
-            if _cmark.NodeType.DOCUMENT != node.type:
+            if _cmark.NodeType.DOCUMENT != node_type:
                 parent = stack.pop();
 
-            if (_cmark.NodeType.HEADING == node.type) and heading:
+            if (_cmark.NodeType.HEADING == node_type) and heading:
                 assert heading['level'], "Popped a heading but we weren't in one?"
-                add_toc_entry(template.placeholder.toc, heading['level'], heading['name'], heading['id'])
-                site.index[source].add(heading['id'])
+                headings.append((heading['level'], heading['name'], heading['id']))
                 heading['level'] = 0
 
     assert not stack, f'Unpopped elements: {stack}'
+    return headings
+
+
+def adapt_native_html(html):
+    # Make libcmark's HTML match what build_article would have built. With
+    # parse_options it renders soft breaks as spaces, so every newline is
+    # one that it put between blocks.
+    html = html.replace('\n', '').replace('&quot;', '"')
+    html = html.replace('<strong>', '<b>').replace('</strong>', '</b>')
+    return _native_whitespace.sub(' ', html)
+
+
+_native_whitespace = _re.compile(r'\s+')
+
+
+def token_classes(code):
+    result = set()
+    for classes in _token_spans.findall(code):
+        result.update(classes.split())
+    return result
+
+
+_token_spans = _re.compile(r'<span class="([^"]+)"')
+
+
+def link_target(source, url):
+    path = url[1:].split('#')[0]
+    if not path:
+        return source
+    elif '.' == path:
+        return 'index'
+    else:
+        return path
 
 
 def add_toc_entry(toc, level, name, url):
@@ -320,6 +986,7 @@ def add_toc_entry(toc, level, name, url):
 
 def check_urls(site):
     checked = {}
+    remote = {}
     for link in site.urls:
         if link.url in checked:
             url = checked[link.url]
@@ -333,7 +1000,7 @@ def check_urls(site):
                     page = 'index'
                 else:
                     page = path
-                assert page in site.index, \
+                assert page in registry, \
                     "File {}:{} links to {}, but this page doesn't exist".format(
                         link.file, link.line, path)
 
@@ -351,45 +1018,249 @@ def check_urls(site):
         else:
             url = link.url
             if site.remote_urls:
-                request = _urlrequest.Request(link.url, method='HEAD')
-                try:
-                    response = _urlrequest.urlopen(request)
-                except _urlrequest.HTTPError as e:
-                    msg = f"On page {link.file}:\nerror checking url '{link.url}':\n{e}\n"
-                    _sys.exit(msg)
-                assert 200 == response.status, \
-                    "url {} got response {} {}".format(
-                        link.url, reponse.status, _http.HTTPStatus(response.status).name)
-                if response.url != link.url:
-                    print(f"On page {link.file}:\nresolved '{link.url}' to:\n{response.url}\n")
+                remote[link.url] = link
 
         _htmltools.set_attribute(link.element, 'href', url)
         if link.url not in checked:
             checked[link.url] = url
 
-
-def render(templates):
-    with _os.scandir('docs') as it:
-        for entry in it:
-            if entry.is_file():
-                if 'CNAME' != entry.name:
-                    _os.remove(entry)
-            elif entry.is_dir():
-                _shutils.rmtree(entry)
-            else:
-                assert False, f"Don't know how to handle file {entry.path}"
+    profile.count('links', len(site.urls))
+    if remote:
+        check_remote_urls(site.checker, remote)
+
+
+def check_remote_urls(checker, links):
+    profile.count('external links', len(links))
+    results = checker.check(links)
+    errors = []
+    for url, link in links.items():
+        result = results[url]
+        if result.error is not None:
+            errors.append(f"On page {link.file}:\nerror checking url '{url}':\n{result.error}\n")
+        elif 200 != result.status:
+            try:
+                reason = _http.HTTPStatus(result.status).phrase
+            except ValueError:
+                reason = ''
+            errors.append(
+                f"On page {link.file}:\nerror checking url '{url}':\n"
+                f"HTTP Error {result.status}: {reason}\n")
+        elif result.final_url != url:
+            print(f"On page {link.file}:\nresolved '{url}' to:\n{result.final_url}\n")
+
+    if checker.cache is not None:
+        cache = checker.cache
+        print(f'Checked {cache.misses} external links ({cache.hits} cached)')
+
+    if errors:
+        _sys.exit('\n'.join(errors))
+
+
+def hash_file(filename):
+    with open(filename, 'rb') as fh:
+        result = _hashlib.sha256(fh.read()).hexdigest()
+    return result
+
+
+def hash_json(value):
+    data = _json.dumps(value, sort_keys=True).encode('utf-8')
+    result = _hashlib.sha256(data).hexdigest()
+    return result
+
+
+def load_manifest(mode):
+    try:
+        with open(manifest_file, 'r') as fh:
+            manifest = _json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+    if (manifest.get('version') != manifest_version
+            or manifest.get('mode') != mode
+            or manifest.get('minify') != minify
+            or manifest.get('native_html') != native_html
+            or manifest.get('tool') != hash_tool()):
+        return {}
+    return manifest['pages']
+
+
+def save_manifest(mode, entries):
+    _os.makedirs(build_dir, exist_ok=True)
+    manifest = {
+        'version': manifest_version,
+        'mode': mode,
+        'minify': minify,
+        'native_html': native_html,
+        'tool': hash_tool(),
+        'pages': entries,
+    }
+    with open(f'{manifest_file}.tmp', 'w') as fh:
+        _json.dump(manifest, fh)
+    _os.replace(f'{manifest_file}.tmp', manifest_file)
+
+
+# The pages in manifest whose page in docs is still the one that was written.
+def unchanged_pages(manifest):
+    result = set()
+    for page, entry in manifest.items():
+        try:
+            digest = hash_file(f'docs/{page}.html')
+        except FileNotFoundError:
+            continue
+        if digest == entry['output']:
+            result.add(page)
+    return result
+
+
+def hash_tool():
+    src = _os.path.dirname(_os.path.abspath(__file__))
+    tool = [hash_file(f'{src}/{module}.py') for module in ('build', 'cmark', 'htmltools', 'search')]
+    tool.append(_cmark.version())
+    return hash_json(tool)
+
+
+def build_incremental(site, pages, nav, manifest, existing, pool=None):
+    entries = {}
+    nav_hash = hash_json(nav)
+    templates = {}
+
+    # First pass: rebuild every page whose own source or template changed
+    # and take the headings, ids and links of every other page from the
+    # manifest, so that we know the full site index and the table of
+    # contents of each section.
+    jobs = []
+    for section, page, include_in_toc in site_pages():
+        if section.template not in templates:
+            templates[section.template] = hash_file(f'templates/{section.template}.html')
+        entry = {
+            'section': section.index,
+            'source': hash_file(f'content/{page}.md'),
+            'template': templates[section.template],
+            'nav': nav_hash,
+        }
+        entries[page] = entry
+        cached = manifest.get(page)
+        if (cached
+                and cached['source'] == entry['source']
+                and cached['template'] == entry['template']
+                and _search.has_page(
+                    search_dir, page, page_key(page, get_template(section.template), include_in_toc))):
+            assert page not in site.index, f"Page {page} exists multiple times?!"
+            entry['headings'] = [tuple(heading) for heading in cached['headings']]
+            site.index[page] = set(cached['ids'])
+            site.links[page] = set(cached['links'])
+            site.tokens[page] = set(cached['tokens'])
+        else:
+            jobs.append((section, page, include_in_toc))
+
+    for page, (template, headings) in build_pages(site, nav, jobs, pool).items():
+        entries[page]['headings'] = headings
+        pages[page] = template
+
+    for section in registry.sections:
+        toc = [
+            (page, entries[page]['headings'])
+            for page, include_in_toc in _content.section_pages(section) if include_in_toc
+        ]
+        toc_hash = hash_json(toc) if section.pages else None
+        for page, _ in _content.section_pages(section):
+            entries[page]['toc'] = toc_hash
+
+    # Second pass: a page that wasn't rebuilt is still stale if its
+    # navigation, table of contents or stylesheet changed or if any page it
+    # links to gained or lost ids.
+    site.style = build_style(site)
+    for page, entry in entries.items():
+        entry['ids'] = sorted(site.index[page])
+        entry['links'] = sorted(site.links[page])
+        entry['tokens'] = sorted(site.tokens[page])
+        entry['style'] = site.style.filename
+    jobs = []
+    for section, page, include_in_toc in site_pages():
+        if page in pages:
+            continue
+        entry = entries[page]
+        cached = manifest[page]
+        stale = (
+            cached['nav'] != entry['nav']
+            or cached['toc'] != entry['toc']
+            or cached['style'] != entry['style']
+            or page not in existing
+        )
+        if not stale:
+            for target in entry['links']:
+                old = manifest[target]['ids'] if target in manifest else None
+                new = entries[target]['ids'] if target in entries else None
+                if old != new:
+                    stale = True
+                    break
+        if stale:
+            del site.index[page]
+            jobs.append((section, page, include_in_toc))
+
+    for page, (template, headings) in build_pages(site, nav, jobs, pool).items():
+        assert headings == entries[page]['headings'], f'Headings changed for {page}'
+        pages[page] = template
+
+    # Finally, every rebuilt page in a section with a table of contents
+    # needs the full table of contents for that section.
+    for section in registry.sections:
+        if not section.pages:
+            continue
+        toc = TocEntries()
+        for page, _ in _content.section_pages(section):
+            result = build_toc_entries(
+                toc, page, get_template(section.template).heading_level,
+                entries[page]['headings'])
+            if page in pages:
+                pages[page].placeholder.toc = result
+
+    return entries
+
+
+def render(output, templates, style, entries=None):
+    if entries is not None:
+        for page in entries:
+            if page not in templates:
+                output.retain(f'{page}.html')
 
     for filename, template in templates.items():
+        with profile.timer('render', filename):
+            prepare_page(template, style)
+            with output.open(f'{filename}.html') as fh:
+                if profile:
+                    fh = _profiling.TimedFile(fh, profile, 'write')
+                _htmltools.write_template(template.doc, template.placeholder, fh, minify=minify)
+
+
+def render_page(template, style):
+    prepare_page(template, style)
+    result = _htmltools.render_template(template.doc, template.placeholder, minify)
+    return result
+
+
+def prepare_page(template, style):
+    template.placeholder.stylesheet = style.link
+    with profile.timer('navigation'):
         template.placeholder.navbar = build_navbar(template.placeholder.navbar)
         if hasattr(template.placeholder, 'toc'):
             template.placeholder.toc = build_toc(template.placeholder.toc)
 
-        output = _htmltools.render_template(template.doc, template.placeholder)
-        with open(f'docs/{filename}.html', 'w') as fh:
-            fh.write(output)
-
 
 def build_navbar(nav):
+    key = (tuple(nav.sections.items()), nav.current, minify)
+    if key not in _navbars:
+        _navbars[key] = _htmltools.render_html(build_navbar_html(nav), minify)
+    html = _htmltools.Html(set())
+    _htmltools.add_html(html, _navbars[key])
+    return html
+
+
+# The rendered navigation bar for every (nav, current section, minify).
+_navbars = {}
+
+
+def build_navbar_html(nav):
     html = _htmltools.Html(set())
     for section, name in nav.sections.items():
         li = _htmltools.add_element(html, 'li')
@@ -403,9 +1274,33 @@ def build_navbar(nav):
 
 
 def build_toc(toc):
-    section = toc.section
-    while toc.stack:
-        toc.toc = toc.stack.pop()
+    # Entries can still be added after a page's table of contents is built.
+    fragments = toc.root.fragments
+    if (fragments is None) or (len(fragments.offsets[False]) != len(toc.root) + 1):
+        toc.root.fragments = TocFragments(toc.root)
+    html = _htmltools.Html(set())
+    _htmltools.add_html(html, toc.root.fragments.render(toc.section))
+    return html
+
+
+def render_toc_entry(entry, page, state):
+    html, state = build_toc_html([entry], page, state)
+    html = _htmltools.render_html(html, minify)
+    assert html.startswith('<ol>') and html.endswith('</ol>'), f'Unexpected table of contents: {html}'
+    return html[len('<ol>'):-len('</ol>')], state
+
+
+def subheading_urls(entry):
+    for subheading in entry.subheadings:
+        yield subheading.url
+        yield from subheading_urls(subheading)
+
+
+# Once it has been to the entry of the current page, build_toc_html checks
+# every collapsible entry that isn't at the top level. Given the state it
+# was left in by the entries before (False, True or _nested), it renders the
+# entries that come after them, and returns the state they leave it in.
+def build_toc_html(entries, section, state=False):
     html = _htmltools.Html(set())
     ol = _htmltools.add_element(html, 'ol')
 
@@ -416,9 +1311,9 @@ def build_toc(toc):
             self.parent = parent
             self.toc = toc
     stack = []
-    it = _Iterator(ol, toc.toc)
+    it = _Iterator(ol, entries)
     page = ''
-    current = False
+    current = stack if state is _nested else state
     while True:
         while it.index < it.max:
             entry = it.toc[it.index]
@@ -464,7 +1359,11 @@ def build_toc(toc):
         else:
             break
 
-    return html
+    state = _nested if current is stack else bool(current)
+    return html, state
+
+
+_nested = 'nested'
 
 
 if __name__ == '__main__':
@@ -1,5 +1,7 @@
+import array as _array
 import collections as _collections
 import ctypes as _ctypes
+import itertools as _itertools
 
 
 _nodes = (
@@ -28,6 +30,10 @@ _nodes = (
 NodeType = _collections.namedtuple('NodeType', _nodes)(*range(len(_nodes)))
 del _nodes
 
+# Not a cmark node type: parse_events uses it for a subtree that libcmark
+# rendered to HTML.
+NATIVE_HTML = len(NodeType)
+
 _lists = ('NO_LIST', 'BULLET_LIST', 'ORDERED_LIST')
 ListType = _collections.namedtuple('ListType', _lists)(*range(len(_lists)))
 del _lists
@@ -113,84 +119,320 @@ def parse_document(filename):
     with open(filename, 'r') as fh:
         text = fh.read()
 
+    if _cmark is None:
+        _load()
     textbytes = text.encode("utf-8")
     textlen = len(textbytes)
     ast = _AST(_parse_document(textbytes, textlen, parse_options))
     return ast
 
 
+# The version of libcmark as an integer, 0xMMmmpp for version MM.mm.pp.
+def version():
+    if _cmark is None:
+        _load()
+    return _version()
+
+
+# Every event of a walk over a document, stored in flat arrays. Event i is
+# events[i] (ENTER or EXIT) for a node of type types[i]. For ENTER events,
+# values[i] is the level of a HEADING or the type of a LIST, and lines[i] is
+# the start line of a block, LINK or IMAGE (it's 0 for other inlines).
+# Strings are kept in one decoded buffer, text: if strings[i] is not -1,
+# string k = strings[i] is text[offsets[k]:offsets[k+1]-1] and holds the
+# literal of the node, or the url of a LINK or IMAGE. The literal of a
+# CODE_BLOCK is string k + 1 and its info string is string k.
+#
+# With native, every paragraph or list that consists only of _native nodes
+# is rendered by libcmark instead: it becomes a single ENTER event of type
+# NATIVE_HTML, whose literal is the HTML. Lists are rendered as loose and
+# starting at 1, which is how build.py builds them.
+class Events:
+    __slots__ = 'events', 'types', 'values', 'lines', 'strings', 'offsets', 'text'
+
+    def __init__(self):
+        self.events = _array.array('B')
+        self.types = _array.array('B')
+        self.values = _array.array('i')
+        self.lines = _array.array('i')
+        self.strings = _array.array('l')
+        self.offsets = _array.array('l')
+        self.text = ''
+
+    def __len__(self):
+        return len(self.events)
+
+    def string(self, k):
+        return self.text[self.offsets[k]:self.offsets[k + 1] - 1]
+
+    def literal(self, i):
+        k = self.strings[i]
+        if NodeType.CODE_BLOCK == self.types[i]:
+            k += 1
+        return self.string(k)
+
+    def url(self, i):
+        return self.string(self.strings[i])
+
+    def info(self, i):
+        return self.string(self.strings[i])
+
+
+def parse_events(filename, native=False):
+    with open(filename, 'rb') as fh:
+        textbytes = fh.read()
+
+    if _cmark is None:
+        _load()
+    node = _parse_document(textbytes, len(textbytes), parse_options)
+    try:
+        it = _iter_new(node)
+        try:
+            result = _walk(it, native)
+        finally:
+            _iter_free(it)
+    finally:
+        _node_free(node)
+    return result
+
+
+def _walk(it, native=False):
+    result = Events()
+    strings = []
+    # Open paragraphs and lists as [node, first event, first string, native].
+    candidates = []
+
+    # Bind everything used in the loop locally: this runs once per node.
+    add_event = result.events.append
+    add_type = result.types.append
+    add_value = result.values.append
+    add_line = result.lines.append
+    add_string = result.strings.append
+    add_bytes = strings.append
+    iter_next = _iter_next
+    iter_get_node = _iter_get_node
+    get_type = _node_get_type
+    get_line = _node_get_start_line
+    get_literal = _node_get_literal
+    ENTER, DONE = EventType.ENTER, EventType.DONE
+    HEADING, LIST, LINK, IMAGE, CODE_BLOCK = (
+        NodeType.HEADING, NodeType.LIST, NodeType.LINK, NodeType.IMAGE, NodeType.CODE_BLOCK)
+    PARAGRAPH, CODE = NodeType.PARAGRAPH, NodeType.CODE
+    native_types = _native
+    literals = _literals
+    inlines = _inlines
+
+    while True:
+        event = iter_next(it)
+        if DONE == event:
+            break
+        node = iter_get_node(it)
+        type = get_type(node)
+        if native:
+            if ENTER == event:
+                if (PARAGRAPH == type) or (LIST == type):
+                    if LIST == type:
+                        _node_set_list_tight(node, 0)
+                        _node_set_list_start(node, 1)
+                    candidates.append([node, len(result.events), len(strings), True])
+                elif candidates and ((type not in native_types)
+                        or (CODE == type) and not get_literal(node).strip()):
+                    candidates[-1][3] = False
+            elif candidates and (candidates[-1][0] == node):
+                _, start, first_string, simple = candidates.pop()
+                if simple:
+                    # Replace the node's events with its HTML. A native node
+                    # inside a native list is rendered once for itself and
+                    # again as part of the list, which is still far cheaper
+                    # than keeping track of which one to render.
+                    _collapse(result, strings, node, start, first_string)
+                    continue
+                elif candidates:
+                    candidates[-1][3] = False
+        add_event(event)
+        add_type(type)
+        if ENTER == event:
+            add_line(get_line(node) if type not in inlines else 0)
+            value = 0
+            if type in literals:
+                add_string(len(strings))
+                add_bytes(get_literal(node))
+            elif (LINK == type) or (IMAGE == type):
+                add_string(len(strings))
+                add_bytes(_node_get_url(node) or b'')
+            elif CODE_BLOCK == type:
+                add_string(len(strings))
+                add_bytes(_node_get_fence_info(node) or b'')
+                add_bytes(get_literal(node))
+            else:
+                add_string(-1)
+                if HEADING == type:
+                    value = _node_get_heading_level(node)
+                elif LIST == type:
+                    value = _node_get_list_type(node)
+            add_value(value)
+        else:
+            add_line(0)
+            add_string(-1)
+            add_value(0)
+
+    # Decode every string at once. Each string is followed by a NUL (which
+    # cmark never leaves in a literal), so string k ends right before
+    # offsets[k + 1]. For pure ASCII the byte lengths are the string lengths.
+    strings.append(b'')
+    data = b'\0'.join(strings)
+    result.text = data.decode('utf-8')
+    if len(data) == len(result.text):
+        lengths = map(len, strings)
+    else:
+        lengths = map(len, result.text.split('\0'))
+    result.offsets = _array.array(
+        'l', _itertools.accumulate(map((1).__add__, lengths), initial=0))
+    return result
+
+
+def _collapse(result, strings, node, start, first_string):
+    line = result.lines[start]
+    for array in (result.events, result.types, result.values, result.lines, result.strings):
+        del array[start:]
+    del strings[first_string:]
+    html = _render_html(node, parse_options)
+    try:
+        strings.append(_ctypes.string_at(html))
+    finally:
+        _free(html)
+    result.events.append(EventType.ENTER)
+    result.types.append(NATIVE_HTML)
+    result.values.append(0)
+    result.lines.append(line)
+    result.strings.append(first_string)
+
+
+_native = frozenset((
+    NodeType.PARAGRAPH,
+    NodeType.LIST,
+    NodeType.ITEM,
+    NodeType.TEXT,
+    NodeType.SOFTBREAK,
+    NodeType.CODE,
+    NodeType.EMPH,
+    NodeType.STRONG,
+))
+_literals = frozenset((
+    NodeType.TEXT,
+    NodeType.CODE,
+    NodeType.HTML_BLOCK,
+    NodeType.HTML_INLINE,
+))
+_inlines = frozenset((
+    NodeType.TEXT,
+    NodeType.SOFTBREAK,
+    NodeType.LINEBREAK,
+    NodeType.CODE,
+    NodeType.HTML_INLINE,
+    NodeType.CUSTOM_INLINE,
+    NodeType.EMPH,
+    NodeType.STRONG,
+))
+
+
+# Nodes and iterators are passed around as plain addresses, which is a lot
+# cheaper than having ctypes box every pointer that libcmark returns.
+_NodePointer = _ctypes.c_void_p
+_IterPointer = _ctypes.c_void_p
 
+_get_node_literal = lambda node: _node_get_literal(node).decode('utf-8')
+_get_node_url = lambda node: _node_get_url(node).decode('utf-8')
 
+_cmark = None
 
-_cmark = _ctypes.CDLL("libcmark.so")
 
+# Load libcmark and bind the functions this module uses. This only happens
+# once a document is parsed, so that importing the module is cheap for
+# commands that never parse anything.
+def _load():
+    global _cmark, _free, _iter_free, _iter_get_node, _iter_next, _iter_new
+    global _node_get_fence_info, _node_get_heading_level
+    global _node_set_heading_level, _node_set_list_start, _node_set_list_tight
+    global _node_get_list_type, _node_get_literal, _node_get_start_line
+    global _node_get_type, _node_get_type_string, _node_get_url, _node_free
+    global _render_html, _parse_document, _version
 
-class _Node(_ctypes.Structure):
-    __slots__ = ()
-_NodePointer = _ctypes.POINTER(_Node)
+    _cmark = _ctypes.CDLL("libcmark.so")
+    # libcmark allocates with the C library's malloc by default.
+    _free = _ctypes.CDLL(None).free
+    _free.argtypes = _ctypes.c_void_p,
 
+    _iter_free = _cmark.cmark_iter_free
+    _iter_free.argtypes = _IterPointer,
 
-class _Iter(_ctypes.Structure):
-    __slots__ = ()
-_IterPointer = _ctypes.POINTER(_Iter)
+    _iter_get_node = _cmark.cmark_iter_get_node
+    _iter_get_node.argtypes = _IterPointer,
+    _iter_get_node.restype = _NodePointer
 
+    _iter_next = _cmark.cmark_iter_next
+    _iter_next.argtypes = _IterPointer,
+    _iter_next.restype = _ctypes.c_int
 
-_iter_free = _cmark.cmark_iter_free
-_iter_free.argtypes = _IterPointer,
+    _iter_new = _cmark.cmark_iter_new
+    _iter_new.argtypes = _NodePointer,
+    _iter_new.restype = _IterPointer
 
-_iter_get_node = _cmark.cmark_iter_get_node
-_iter_get_node.argtypes = _IterPointer,
-_iter_get_node.restype = _NodePointer
+    _node_get_fence_info = _cmark.cmark_node_get_fence_info
+    _node_get_fence_info.argtypes = _NodePointer,
+    _node_get_fence_info.restype = _ctypes.c_char_p
 
-_iter_next = _cmark.cmark_iter_next
-_iter_next.argtypes = _IterPointer,
-_iter_next.restype = _ctypes.c_int
+    _node_get_heading_level = _cmark.cmark_node_get_heading_level
+    _node_get_heading_level.argtypes = _NodePointer,
+    _node_get_heading_level.restype = _ctypes.c_int
 
-_iter_new = _cmark.cmark_iter_new
-_iter_new.argtypes = _NodePointer,
-_iter_new.restype = _IterPointer
+    _node_set_heading_level = _cmark.cmark_node_set_heading_level
+    _node_set_heading_level.argtypes = _NodePointer, _ctypes.c_int
+    _node_set_heading_level.restype = _ctypes.c_int
 
-_node_get_fence_info = _cmark.cmark_node_get_fence_info
-_node_get_fence_info.argtypes = _NodePointer,
-_node_get_fence_info.restype = _ctypes.c_char_p
+    _node_set_list_start = _cmark.cmark_node_set_list_start
+    _node_set_list_start.argtypes = _NodePointer, _ctypes.c_int
+    _node_set_list_start.restype = _ctypes.c_int
 
-_node_get_heading_level = _cmark.cmark_node_get_heading_level
-_node_get_heading_level.argtypes = _NodePointer,
-_node_get_heading_level.restype = _ctypes.c_int
+    _node_set_list_tight = _cmark.cmark_node_set_list_tight
+    _node_set_list_tight.argtypes = _NodePointer, _ctypes.c_int
+    _node_set_list_tight.restype = _ctypes.c_int
 
-_node_set_heading_level = _cmark.cmark_node_set_heading_level
-_node_set_heading_level.argtypes = _NodePointer, _ctypes.c_int
-_node_set_heading_level.restype = _ctypes.c_int
+    _node_get_list_type = _cmark.cmark_node_get_list_type
+    _node_get_list_type.argtypes = _NodePointer,
+    _node_get_list_type.restype = _ctypes.c_int
 
-_node_get_list_type = _cmark.cmark_node_get_list_type
-_node_get_list_type.argtypes = _NodePointer,
-_node_get_list_type.restype = _ctypes.c_int
+    _node_get_literal = _cmark.cmark_node_get_literal
+    _node_get_literal.argtypes = _NodePointer,
+    _node_get_literal.restype = _ctypes.c_char_p
 
-_node_get_literal = _cmark.cmark_node_get_literal
-_node_get_literal.argtypes = _NodePointer,
-_node_get_literal.restype = _ctypes.c_char_p
-_get_node_literal = lambda node: _node_get_literal(node).decode('utf-8')
+    _node_get_start_line = _cmark.cmark_node_get_start_line
+    _node_get_start_line.argtypes = _NodePointer,
+    _node_get_start_line.restype = _ctypes.c_int
 
-_node_get_start_line = _cmark.cmark_node_get_start_line
-_node_get_start_line.argtypes = _NodePointer,
-_node_get_start_line.restype = _ctypes.c_int
+    _node_get_type = _cmark.cmark_node_get_type
+    _node_get_type.argtypes = _NodePointer,
+    _node_get_type.restype = _ctypes.c_int
 
-_node_get_type = _cmark.cmark_node_get_type
-_node_get_type.argtypes = _NodePointer,
-_node_get_type.restype = _ctypes.c_int
+    _node_get_type_string = _cmark.cmark_node_get_type_string
+    _node_get_type_string.argtypes = _NodePointer,
+    _node_get_type_string.restype = _ctypes.c_char_p
 
-_node_get_type_string = _cmark.cmark_node_get_type_string
-_node_get_type_string.argtypes = _NodePointer,
-_node_get_type_string.restype = _ctypes.c_char_p
+    _node_get_url = _cmark.cmark_node_get_url
+    _node_get_url.argtypes = _NodePointer,
+    _node_get_url.restype = _ctypes.c_char_p
 
-_node_get_url = _cmark.cmark_node_get_url
-_node_get_url.argtypes = _NodePointer,
-_node_get_url.restype = _ctypes.c_char_p
-_get_node_url = lambda node: _node_get_url(node).decode('utf-8')
+    _node_free = _cmark.cmark_node_free
+    _node_free.argtypes = _NodePointer,
+
+    _render_html = _cmark.cmark_render_html
+    _render_html.argtypes = _NodePointer, _ctypes.c_int
+    _render_html.restype = _ctypes.c_void_p
 
-_node_free = _cmark.cmark_node_free
-_node_free.argtypes = _NodePointer,
+    _parse_document = _cmark.cmark_parse_document
+    _parse_document.argtypes = _ctypes.c_char_p, _ctypes.c_ulonglong, _ctypes.c_int
+    _parse_document.restype = _NodePointer
 
-_parse_document = _cmark.cmark_parse_document
-_parse_document.argtypes = _ctypes.c_char_p, _ctypes.c_ulonglong, _ctypes.c_int
-_parse_document.restype = _NodePointer
+    _version = _cmark.cmark_version
+    _version.argtypes = ()
+    _version.restype = _ctypes.c_int
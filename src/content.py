@@ -0,0 +1,85 @@
+import collections as _collections
+import fnmatch as _fnmatch
+import json as _json
+import os as _os
+
+
+Section = _collections.namedtuple('Section', ('name', 'template', 'index', 'pages'))
+Page = _collections.namedtuple('Page', ('name', 'section', 'include_in_toc'))
+
+sections_file = 'sections.json'
+
+
+# Every page of the site, in site order: the index page of each section,
+# which isn't in the section's table of contents, followed by the pages that
+# are. Sections without a name aren't in the navigation bar.
+class Registry:
+    __slots__ = 'sections', 'pages', 'nav'
+
+    def __init__(self, sections):
+        self.sections = tuple(sections)
+        self.pages = {}
+        self.nav = {}
+        for section in self.sections:
+            if section.name:
+                self.nav[section.name] = section.index
+            for name, include_in_toc in section_pages(section):
+                assert name not in self.pages, \
+                    f'Page {name} is in both {self.pages[name].section.index} and {section.index}'
+                self.pages[name] = Page(name, section, include_in_toc)
+
+
+    def __contains__(self, name):
+        return name in self.pages
+
+
+    def __iter__(self):
+        return iter(self.pages.values())
+
+
+
+# Read the sections of the site from sections_file in directory, a JSON list
+# of objects with the fields of a Section. Each of pages is either the name
+# of a page or a glob pattern ('reference-*') that adds every matching page
+# in directory that isn't listed anywhere else, in sorted order.
+def load(directory):
+    with open(_os.path.join(directory, sections_file), 'r') as fh:
+        sections = _json.load(fh)
+
+    available = None
+    listed = {
+        page
+        for section in sections
+        for page in (section['index'], *section.get('pages', ()))
+        if not _is_pattern(page)
+    }
+    result = []
+    for section in sections:
+        pages = []
+        for page in section.get('pages', ()):
+            if _is_pattern(page):
+                if available is None:
+                    available = sorted(
+                        name[:-3] for name in _os.listdir(directory) if name.endswith('.md'))
+                matches = [name for name in _fnmatch.filter(available, page) if name not in listed]
+                listed.update(matches)
+                pages.extend(matches)
+            else:
+                pages.append(page)
+        result.append(Section(
+            name=section.get('name'),
+            template=section['template'],
+            index=section['index'],
+            pages=tuple(pages),
+        ))
+    return Registry(result)
+
+
+def section_pages(section):
+    yield section.index, False
+    for page in section.pages:
+        yield page, True
+
+
+def _is_pattern(page):
+    return any(c in page for c in '*?[')
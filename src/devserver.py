@@ -0,0 +1,173 @@
+import http.server as _httpserver
+import os as _os
+import threading as _threading
+import time as _time
+import traceback as _traceback
+import urllib.parse as _urlparse
+
+
+poll_interval = 0.1
+keepalive_interval = 15
+reload_path = '/__livereload'
+reload_script = (
+    f'<script>new EventSource("{reload_path}").onmessage = '
+    'function () { location.reload(); };</script>'
+)
+
+_content_types = {
+    '.css': 'text/css; charset=utf-8',
+    '.html': 'text/html; charset=utf-8',
+    '.js': 'text/javascript; charset=utf-8',
+    '.json': 'application/json',
+}
+
+
+class Server:
+    __slots__ = 'address', 'directories', 'rebuild', 'live_reload', 'outputs', 'generation', 'condition'
+
+    def __init__(self, address, directories, rebuild, live_reload=False):
+        self.address = address
+        self.directories = directories
+        self.rebuild = rebuild
+        self.live_reload = live_reload
+        self.outputs = {}
+        self.generation = 0
+        self.condition = _threading.Condition()
+
+
+    def serve_forever(self):
+        snapshot = self.snapshot()
+        self.update(set(snapshot))
+
+        httpd = _httpserver.ThreadingHTTPServer(self.address, _make_handler(self))
+        httpd.daemon_threads = True
+        thread = _threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        host, port = httpd.server_address[:2]
+        print(f'Serving on http://{host}:{port}/')
+
+        try:
+            while True:
+                _time.sleep(poll_interval)
+                current = self.snapshot()
+                if current != snapshot:
+                    changed = {
+                        path for path in snapshot.keys() | current.keys()
+                        if snapshot.get(path) != current.get(path)
+                    }
+                    snapshot = current
+                    self.update(changed)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+
+    def snapshot(self):
+        result = {}
+        for directory in self.directories:
+            for dirpath, _, filenames in _os.walk(directory):
+                for name in filenames:
+                    path = _os.path.join(dirpath, name)
+                    try:
+                        stat = _os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    result[path] = (stat.st_mtime_ns, stat.st_size)
+        return result
+
+
+    def update(self, changed):
+        start = _time.perf_counter()
+        outputs = dict(self.outputs)
+        try:
+            rebuilt = self.rebuild(outputs, changed)
+        except Exception:
+            _traceback.print_exc()
+            return
+
+        elapsed = (_time.perf_counter() - start) * 1000
+        print(f'Rebuilt {rebuilt} pages in {elapsed:.0f} ms')
+        with self.condition:
+            self.outputs = outputs
+            self.generation += 1
+            self.condition.notify_all()
+
+
+    def get(self, path):
+        path = _urlparse.urlsplit(path).path.lstrip('/')
+        if not path:
+            path = 'index.html'
+        elif path.endswith('/'):
+            path = f'{path}index.html'
+        elif path not in self.outputs and f'{path}.html' in self.outputs:
+            path = f'{path}.html'
+
+        content = self.outputs.get(path)
+        if content is None:
+            return None, None
+
+        ext = _os.path.splitext(path)[1]
+        if self.live_reload and ('.html' == ext):
+            if '</body>' in content:
+                content = content.replace('</body>', f'{reload_script}</body>', 1)
+            else:
+                # Minified pages leave out the optional end tag.
+                content += reload_script
+        return _content_types.get(ext, 'application/octet-stream'), content.encode('utf-8')
+
+
+    def wait(self, generation, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation, timeout)
+            return self.generation
+
+
+
+def _make_handler(server):
+
+    class _Handler(_httpserver.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if server.live_reload and (reload_path == self.path):
+                self.send_events()
+                return
+
+            content_type, body = server.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(body)
+
+
+        def send_events(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+
+            generation = server.generation
+            try:
+                while True:
+                    current = server.wait(generation, keepalive_interval)
+                    if current != generation:
+                        generation = current
+                        self.wfile.write(b'data: reload\n\n')
+                    else:
+                        self.wfile.write(b': keepalive\n\n')
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+
+        def log_message(self, format, *args):
+            pass
+
+    return _Handler
@@ -1,7 +1,7 @@
+import array as _array
 import collections as _collections
 import functools as _functools
 import html as _html
-import html.parser as _htmlparser
 import re as _re
 
 
@@ -12,17 +12,94 @@ class Html:
         self.content = []
         self.placeholders = set()
         self.heading_level = 0
+        self.compiled = None
+        self.minified = None
 
 
-class _TemplateBuilder(_htmlparser.HTMLParser):
 
-    def __init__(self, html, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+# The ids of a document made from a template: the template's own ids, which
+# every such document shares, plus the ones added to this document.
+class IdSet:
+    __slots__ = 'base', 'added'
+
+    def __init__(self, base):
+        self.base = base
+        self.added = set()
+
+
+    def __contains__(self, id):
+        return (id in self.added) or (id in self.base)
+
+
+    def __iter__(self):
+        yield from self.base
+        yield from self.added
+
+
+    def __len__(self):
+        return len(self.base) + len(self.added)
+
+
+    def add(self, id):
+        self.added.add(id)
+
+
+    def update(self, ids):
+        self.added.update(ids)
+
+
+    def isdisjoint(self, ids):
+        return self.base.isdisjoint(ids) and self.added.isdisjoint(ids)
+
+
+# Builds a document from a template. Templates are a restricted form of
+# html: besides text and elements they can only have a doctype, comments and
+# placeholders ('{{ name }}'), which must be the only text in their element.
+# Text and attribute values have character references replaced, except in
+# script and style elements, whose content is taken as is.
+class _TemplateBuilder:
+
+    def __init__(self, html):
         self.template = html
         self.html = html
         self.stack = []
 
 
+    def feed(self, text):
+        pos = 0
+        for token in _template_token.finditer(text):
+            if token.start() != pos:
+                break
+            pos = token.end()
+            kind = token.lastgroup
+            if 'text' == kind:
+                data = token.group('text')
+                self.handle_data(_html.unescape(data) if '&' in data else data)
+            elif 'closed' == kind:
+                tag, attrs, closed = token.group('tag', 'attrs', 'closed')
+                tag = tag.lower()
+                attrs = _template_attributes(attrs) if attrs else ()
+                if closed:
+                    self.handle_startendtag(tag, attrs)
+                else:
+                    assert tag not in _template_raw_text, f'{tag} element is never closed'
+                    self.handle_starttag(tag, attrs)
+            elif 'end' == kind:
+                self.handle_endtag(token.group('end').lower())
+            elif 'raw' == kind:
+                tag, attrs, raw = token.group('rawtag', 'rawattrs', 'raw')
+                tag = tag.lower()
+                self.handle_starttag(tag, _template_attributes(attrs) if attrs else ())
+                if raw:
+                    self.handle_data(raw)
+                self.handle_endtag(tag)
+            elif 'decl' == kind:
+                self.handle_decl(token.group('decl'))
+        if pos != len(text):
+            line = text.count('\n', 0, pos) + 1
+            assert False, f'Unexpected markup on line {line}: {text[pos:pos + 20]!r}'
+
+
     def handle_starttag(self, tag, attrs):
         element = add_element(self.html, tag)
 
@@ -33,20 +110,7 @@ class _TemplateBuilder(_htmlparser.HTMLParser):
             self.stack.append(self.html)
             self.html = element
 
-        if 'h1' == tag:
-            heading = 1
-        elif 'h2' == tag:
-            heading = 2
-        elif 'h3' == tag:
-            heading = 3
-        elif 'h4' == tag:
-            heading = 4
-        elif 'h5' == tag:
-            heading = 5
-        elif 'h6' == tag:
-            heading = 6
-        else:
-            heading = 0
+        heading = _template_headings.get(tag, 0)
         if heading > self.template.heading_level:
             self.template.heading_level = heading
 
@@ -62,7 +126,7 @@ class _TemplateBuilder(_htmlparser.HTMLParser):
 
 
     def handle_data(self, data):
-        placeholder = _placeholder_text.match(data)
+        placeholder = _placeholder_text.match(data) if '{{' in data else None
         if placeholder:
             placeholder = placeholder.group(1)
             assert placeholder not in self.template.placeholders, f'placeholder {placeholder} repeated'
@@ -79,8 +143,18 @@ class _TemplateBuilder(_htmlparser.HTMLParser):
         self.html.content.append(_DocType(f'<!{decl}>'))
 
 
-    def unknown_decl(self, decl):
-        assert False, f"Unknown declaration: '{decl}'"
+def _template_attributes(attrs):
+    result = []
+    for name, value in _template_attribute.findall(attrs):
+        if not value:
+            value = None
+        else:
+            if value[0] in '"\'':
+                value = value[1:-1]
+            if '&' in value:
+                value = _html.unescape(value)
+        result.append((name.lower(), value))
+    return result
 
 
 def build_template(filename):
@@ -90,10 +164,32 @@ def build_template(filename):
     builder = _TemplateBuilder(Html(set()))
     builder.feed(html)
     result = builder.template
+    result.compiled = compile_template(result)
+    return result
+
+
+def compile_template(doc, minify=False):
+    assert doc.content, f'document is empty'
+
+    output = []
+    _render(doc.content, output.append, output.append, minify, _document)
+
+    result = []
+    static = []
+    for chunk in output:
+        if isinstance(chunk, _Placeholder):
+            result.append(''.join(static))
+            result.append(chunk)
+            static = []
+        else:
+            static.append(chunk)
+    result.append(''.join(static))
     return result
 
 
 def add_element(parent, tag):
+    if isinstance(parent, _compact):
+        return parent.doc.add_element(parent.index, tag)
     assert _ContentType.NONE != parent.allow, f'Tried to add element to {parent}'
     element = _Element(parent.ids, tag, **_elements[tag])
     parent.content.append(element)
@@ -101,12 +197,17 @@ def add_element(parent, tag):
 
 
 def add_html(parent, html):
+    if isinstance(parent, _compact):
+        parent.doc.add_html(parent.index, html)
+        return
     assert _ContentType.NONE != parent.allow, f'Tried to add html to {parent}'
     parent.content.append(_RawHtml(html))
 
 
 def add_text(element, text, omit_if_whitespace=True):
-    if _ContentType.ANY != element.allow:
+    if isinstance(element, _compact):
+        element.doc.add_text(element.index, text, omit_if_whitespace)
+    elif _ContentType.ANY != element.allow:
         assert '' == text.strip(), f"{element}: can't accept text '{text}'"
     else:
         prev = element.content[-1] if element.content else None
@@ -125,6 +226,9 @@ def add_text(element, text, omit_if_whitespace=True):
 
 
 def set_attribute(element, name, value=None):
+    if isinstance(element, _Node):
+        element.doc.set_attribute(element.index, name, value)
+        return
     assert name not in element.attrs, f'Attribute {name} already set'
     element.attrs[name] = value
 
@@ -133,74 +237,428 @@ def set_attribute(element, name, value=None):
         element.ids.add(value)
 
 
-def render_template(doc, templates):
-    assert doc.content, f'document is empty'
+# Convert a compact document into a tuple of bytes and lists of strings and
+# back, so that it can be stored with marshal. Elements are identified by
+# their index, which stays the same.
+def dump_html(doc):
+    result = (
+        doc.kinds.tobytes(),
+        doc.values.tobytes(),
+        doc.first_child.tobytes(),
+        doc.last_child.tobytes(),
+        doc.next_sibling.tobytes(),
+        doc.first_attribute.tobytes(),
+        doc.next_attribute.tobytes(),
+        doc.strings,
+        doc.attribute_names,
+        doc.attribute_values,
+    )
+    return result
+
+
+def load_html(ids, data):
+    result = CompactHtml(ids)
+    (kinds, values, first_child, last_child, next_sibling, first_attribute, next_attribute,
+        result.strings, result.attribute_names, result.attribute_values) = data
+    result.kinds = _array.array('B', kinds)
+    result.values = _array.array('i', values)
+    result.first_child = _array.array('i', first_child)
+    result.last_child = _array.array('i', last_child)
+    result.next_sibling = _array.array('i', next_sibling)
+    result.first_attribute = _array.array('i', first_attribute)
+    result.next_attribute = _array.array('i', next_attribute)
+    return result
+
+
+# Convert a template into a tuple of strings and lists, so that it can be
+# stored with marshal. What comes back can be rendered, in either mode, but
+# has no content to build on.
+def dump_template(doc):
+    if doc.minified is None:
+        doc.minified = compile_template(doc, True)
+    result = (
+        sorted(doc.ids),
+        sorted(doc.placeholders),
+        doc.heading_level,
+        [_dump_chunk(chunk) for chunk in doc.compiled],
+        [_dump_chunk(chunk) for chunk in doc.minified],
+    )
+    return result
+
+
+def load_template(data):
+    ids, placeholders, heading_level, compiled, minified = data
+    result = Html(set(ids))
+    result.placeholders = set(placeholders)
+    result.heading_level = heading_level
+    # A compiled template alternates between static text and placeholders,
+    # starting and ending with text.
+    result.compiled = [_Placeholder(chunk) if i % 2 else chunk for i, chunk in enumerate(compiled)]
+    result.minified = [_Placeholder(chunk) if i % 2 else chunk for i, chunk in enumerate(minified)]
+    return result
+
 
+def _dump_chunk(chunk):
+    return chunk.name if isinstance(chunk, _Placeholder) else chunk
+
+
+def element_index(element):
+    return element.index
+
+
+def element_at(doc, index):
+    assert _ELEMENT == doc.kinds[index], f'Node {index} is not an element'
+    return _Node(doc, index)
+
+
+# Yield the text of a compact document in document order as (anchor,
+# heading, text): anchor is the id of the last heading (h1 to h6) that
+# started at or before the text, or None, and heading says whether the text
+# is inside that heading. Raw html yields its text content.
+def iter_text(doc):
+    kinds = doc.kinds
+    values = doc.values
+    first_child = doc.first_child
+    next_sibling = doc.next_sibling
+    strings = doc.strings
+    anchor = None
+    heading = -1
+    node = first_child[0]
+    stack = []
+    while True:
+        while -1 != node:
+            kind = kinds[node]
+            if _ELEMENT == kind:
+                if values[node] in _heading_tags:
+                    heading = node
+                    attribute = doc.first_attribute[node]
+                    while -1 != attribute:
+                        if 'id' == doc.attribute_names[attribute]:
+                            anchor = doc.attribute_values[attribute]
+                        attribute = doc.next_attribute[attribute]
+                child = first_child[node]
+                if -1 != child:
+                    stack.append(node)
+                    node = child
+                    continue
+                elif heading == node:
+                    heading = -1
+
+            elif _RAW == kind:
+                text = _raw_block_tags.sub(' ', strings[values[node]])
+                yield anchor, -1 != heading, _html.unescape(_raw_tags.sub('', text))
+
+            else:
+                yield anchor, -1 != heading, strings[values[node]]
+
+            node = next_sibling[node]
+
+        if stack:
+            node = stack.pop()
+            if heading == node:
+                heading = -1
+            node = next_sibling[node]
+        else:
+            break
+
+
+def render_html(doc, minify=False):
+    output = []
+    _render(doc.content, output.append, _unexpected_placeholder, minify)
+    result = ''.join(output)
+    return result
+
+
+def render_template(doc, templates, minify=False):
     output = []
-    it = _Iterator(doc.content)
+    _render_template(doc, templates, output.append, minify)
+    result = ''.join(output)
+    return result
+
+
+def write_template(doc, templates, fh, buffer_size=64 * 1024, minify=False):
+    writer = _BufferedWriter(fh, buffer_size)
+    _render_template(doc, templates, writer.write, minify)
+    writer.flush()
+
+
+def _render_template(doc, templates, write, minify):
+    if minify:
+        if doc.minified is None:
+            doc.minified = compile_template(doc, True)
+        compiled = doc.minified
+    else:
+        compiled = doc.compiled if doc.compiled is not None else compile_template(doc)
+    for chunk in compiled:
+        if isinstance(chunk, _Placeholder):
+            placeholder = getattr(templates, chunk.name)
+            if isinstance(placeholder, CompactHtml):
+                _render_compact(placeholder, write, minify)
+            else:
+                _render(placeholder.content, write, _unexpected_placeholder, minify)
+        else:
+            write(chunk)
+
+
+# When minifying, parent is the tag of the element that contains items, or
+# None if that isn't known (as for the content of a placeholder). Nothing is
+# left out next to content we can't see.
+def _render(items, write, placeholder, minify=False, parent=None):
+    it = _Iterator(items)
     stack = []
     while True:
         while it.index < it.end:
             element = it.items[it.index]
             if isinstance(element, _DocType):
-                output.append(element.doctype)
+                write(element.doctype)
 
             elif isinstance(element, _Element):
                 if element.attrs:
-                    attrs = []
-                    for name, value in element.attrs.items():
-                        if value is None:
-                            attrs.append(f' {name}')
-                        else:
-                            attrs.append(' {}="{}"'.format(name, escape_attribute(value)))
-                    attrs = ''.join(attrs)
+                    attrs = ''.join([
+                        _render_attribute(name, value, minify)
+                        for name, value in element.attrs.items()
+                    ])
                 else:
                     attrs = ''
-                output.append(f'<{element.tag}{attrs}>')
+                write(f'<{element.tag}{attrs}>')
 
                 if element.content:
                     stack.append(it)
                     it = _Iterator(element.content)
                     continue
                 elif element.content is not None:
-                    output.append(f'</{element.tag}>')
+                    if not (minify and _omit_end_tag(element.tag, it, stack, parent)):
+                        write(f'</{element.tag}>')
 
 
             elif isinstance(element, _Placeholder):
-                placeholder = element.name
-                placeholder = getattr(templates, placeholder)
-                it = _Iterator(placeholder.content)
-                continue
+                placeholder(element)
 
             elif isinstance(element, _PreformattedText):
                 text = ''.join(element.content)
-                output.append(escape_text(text))
+                write(escape_text(text))
 
             elif isinstance(element, _RawHtml):
-                output.append(element.html)
+                write(element.html)
 
             elif isinstance(element, _Text):
                 text = ''.join(element.content)
                 text = _normalize_whitespace(text)
-                if not ((' ' == text) and element.omit_if_whitespace):
-                    output.append(escape_text(text))
+                if not ((' ' == text) and (element.omit_if_whitespace
+                        or (minify and _insignificant_space(it.items, it.index, stack, parent)))):
+                    write(escape_text(text))
 
             else:
                 assert False, f'Unexpected element type: {element}'
-                output.append(_html.escape(element, False))
+                write(_html.escape(element, False))
 
             it.index += 1
 
         if stack:
             it = stack.pop()
             element = it.items[it.index]
-            output.append(f'</{element.tag}>')
+            if not (minify and _omit_end_tag(element.tag, it, stack, parent)):
+                write(f'</{element.tag}>')
             it.index +=1
         else:
             break
 
-    result = ''.join(output)
-    return result
+
+def _render_compact(doc, write, minify=False):
+    kinds = doc.kinds
+    values = doc.values
+    first_child = doc.first_child
+    next_sibling = doc.next_sibling
+    strings = doc.strings
+    node = first_child[0]
+    previous = -1
+    stack = []
+    while True:
+        while -1 != node:
+            kind = kinds[node]
+            if _ELEMENT == kind:
+                tag = _tag_names[values[node]]
+                attribute = doc.first_attribute[node]
+                if -1 != attribute:
+                    attrs = []
+                    while -1 != attribute:
+                        attrs.append(_render_attribute(
+                            doc.attribute_names[attribute], doc.attribute_values[attribute], minify))
+                        attribute = doc.next_attribute[attribute]
+                    write(f"<{tag}{''.join(attrs)}>")
+                else:
+                    write(f'<{tag}>')
+
+                child = first_child[node]
+                if -1 != child:
+                    stack.append((node, previous))
+                    node = child
+                    previous = -1
+                    continue
+                elif _ContentType.NONE != _tag_allow[values[node]]:
+                    if not (minify and _compact_omit_end_tag(doc, node, stack)):
+                        write(f'</{tag}>')
+
+            elif (_TEXT == kind) or (_KEPT_TEXT == kind):
+                text = _normalize_whitespace(strings[values[node]])
+                if not ((' ' == text) and ((_TEXT == kind)
+                        or (minify and _compact_insignificant_space(doc, node, previous, stack)))):
+                    write(escape_text(text))
+
+            elif _PREFORMATTED == kind:
+                write(escape_text(strings[values[node]]))
+
+            else:
+                assert _RAW == kind, f'Unexpected node type: {kind}'
+                write(strings[values[node]])
+
+            previous = node
+            node = next_sibling[node]
+
+        if stack:
+            node, previous = stack.pop()
+            if not (minify and _compact_omit_end_tag(doc, node, stack)):
+                write(f'</{_tag_names[values[node]]}>')
+            previous = node
+            node = next_sibling[node]
+        else:
+            break
+
+
+def _render_attribute(name, value, minify):
+    if value is None:
+        return f' {name}'
+    elif minify and _unquoted_value.fullmatch(value):
+        return f' {name}={value}'
+    else:
+        return ' {}="{}"'.format(name, escape_attribute(value))
+
+
+def _omit_end_tag(tag, it, stack, parent):
+    if tag not in _optional_end_tags:
+        return False
+
+    following = _following(it, stack, parent)
+    if following is None:
+        return False
+    elif following is _end:
+        return _omittable(tag, _end, _parent_tag(stack, parent))
+    elif isinstance(following, _Element):
+        return _omittable(tag, following.tag, None)
+    else:
+        return False
+
+
+def _compact_omit_end_tag(doc, node, stack):
+    tag = _tag_names[doc.values[node]]
+    if tag not in _optional_end_tags:
+        return False
+
+    previous = node
+    following = doc.next_sibling[node]
+    while -1 != following:
+        kind = doc.kinds[following]
+        if not (((_TEXT == kind) or (_KEPT_TEXT == kind))
+                and (' ' == _normalize_whitespace(doc.strings[doc.values[following]]))
+                and ((_TEXT == kind) or _compact_insignificant_space(doc, following, previous, stack))):
+            break
+        previous = following
+        following = doc.next_sibling[following]
+
+    if -1 == following:
+        # The top level of a compact document is placeholder content.
+        if not stack:
+            return False
+        return _omittable(tag, _end, _tag_names[doc.values[stack[-1][0]]])
+    elif _ELEMENT == doc.kinds[following]:
+        return _omittable(tag, _tag_names[doc.values[following]], None)
+    else:
+        return False
+
+
+# Whether the end tag of an element can be left out when it is followed by
+# an element with the tag following, or by the end (_end) of its parent.
+def _omittable(tag, following, parent):
+    if following is _end:
+        return ('p' != tag) or (parent not in _p_end_required)
+    elif 'p' == tag:
+        return following in _p_closers
+    elif 'li' == tag:
+        return 'li' == following
+    else:
+        return True
+
+
+# Return the next item that will be rendered after the current one, _end if
+# the current item is the last in its parent, or None if we don't know.
+def _following(it, stack, parent):
+    for i in range(it.index + 1, it.end):
+        item = it.items[i]
+        if (isinstance(item, _Text) and (' ' == _normalize_whitespace(''.join(item.content)))
+                and (item.omit_if_whitespace or _insignificant_space(it.items, i, stack, parent))):
+            continue
+        return item
+    if stack or (parent is not None):
+        return _end
+    return None
+
+
+def _insignificant_space(items, index, stack, parent):
+    for ancestor in stack:
+        if 'pre' == ancestor.items[ancestor.index].tag:
+            return False
+
+    if stack or (parent is not None):
+        tag = _parent_tag(stack, parent)
+        boundary = (_document == tag) or (tag in _block_elements)
+    else:
+        boundary = False
+    before = _is_block(items[index - 1]) if index > 0 else _end
+    after = _is_block(items[index + 1]) if index + 1 < len(items) else _end
+    return _separates_blocks(before, after, boundary)
+
+
+def _compact_insignificant_space(doc, node, previous, stack):
+    tags = [_tag_names[doc.values[ancestor]] for ancestor, _ in stack]
+    if 'pre' in tags:
+        return False
+
+    boundary = bool(tags) and (tags[-1] in _block_elements)
+    before = _is_compact_block(doc, previous) if -1 != previous else _end
+    following = doc.next_sibling[node]
+    after = _is_compact_block(doc, following) if -1 != following else _end
+    return _separates_blocks(before, after, boundary)
+
+
+# Whitespace doesn't render when on both sides of it there's a block element
+# or, if its parent is a block element (boundary), the start or end of it.
+def _separates_blocks(before, after, boundary):
+    for side in (before, after):
+        if side is _end:
+            if not boundary:
+                return False
+        elif not side:
+            return False
+    return True
+
+
+def _parent_tag(stack, parent):
+    if stack:
+        ancestor = stack[-1]
+        return ancestor.items[ancestor.index].tag
+    return parent
+
+
+def _is_block(item):
+    return isinstance(item, _Element) and (item.tag in _block_elements)
+
+
+def _is_compact_block(doc, node):
+    return (_ELEMENT == doc.kinds[node]) and (_tag_names[doc.values[node]] in _block_elements)
+
+
+def _unexpected_placeholder(element):
+    assert False, f'Unexpected placeholder in placeholder content: {element}'
 
 
 def escape_attribute(text):
@@ -213,7 +671,20 @@ def escape_text(text):
     return result
 
 
+_unquoted_value = _re.compile(r'[^\s"\'=<>`&]+')
 _placeholder_text = _re.compile(r'^\s*\{\{\s*([a-z]+)\s*\}\}\s*$')
+_template_attrs = r'''(?:\s+[^\s"'/<>=]+(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'<>=`]+))?)*'''
+_template_token = _re.compile(rf'''
+    (?P<text>[^<]+)
+    | <!--.*?-->
+    | <!(?P<decl>[^>-][^>]*)>
+    | </(?P<end>[a-z][^\s/>]*)\s*>
+    | <(?P<rawtag>script|style)(?P<rawattrs>{_template_attrs})\s*>(?P<raw>.*?)</(?P=rawtag)\s*>
+    | <(?P<tag>[a-z][^\s/>]*)(?P<attrs>{_template_attrs})\s*(?P<closed>/?)>
+''', _re.DOTALL | _re.IGNORECASE | _re.VERBOSE)
+_template_attribute = _re.compile(r'''([^\s"'/<>=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s"'<>=`]+))?''')
+_template_headings = {f'h{level}': level for level in range(1, 7)}
+_template_raw_text = frozenset(('script', 'style'))
 _non_id_chars = _re.compile(r'[^\w -]')
 def urlify(text):
     result = _non_id_chars.sub('', text).replace(' ', '-').lower()
@@ -234,6 +705,7 @@ _elements = {
     'code': {'allow': _ContentType.ANY},
     'em': {'allow': _ContentType.ANY},
     'footer': {'allow': _ContentType.ANY},
+    'form': {'allow': _ContentType.ANY},
     'h1': {'allow': _ContentType.ANY},
     'h2': {'allow': _ContentType.ANY},
     'h3': {'allow': _ContentType.ANY},
@@ -260,6 +732,176 @@ _elements = {
 }
 
 
+# Elements that always start on a line of their own, so whitespace between
+# them or at the start or end of them doesn't render.
+_block_elements = frozenset((
+    'address', 'article', 'aside', 'blockquote', 'body', 'dd', 'details', 'div',
+    'dl', 'dt', 'fieldset', 'figcaption', 'figure', 'footer', 'form', 'h1', 'h2',
+    'h3', 'h4', 'h5', 'h6', 'head', 'header', 'hgroup', 'hr', 'html', 'li', 'main',
+    'menu', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'ul',
+))
+
+# https://html.spec.whatwg.org/multipage/syntax.html#optional-tags
+_optional_end_tags = frozenset(('body', 'head', 'html', 'li', 'p'))
+_p_closers = frozenset((
+    'address', 'article', 'aside', 'blockquote', 'details', 'div', 'dl',
+    'fieldset', 'figcaption', 'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4',
+    'h5', 'h6', 'header', 'hgroup', 'hr', 'main', 'menu', 'nav', 'ol', 'p', 'pre',
+    'section', 'table', 'ul',
+))
+_p_end_required = frozenset(('a', 'audio', 'del', 'ins', 'map', 'noscript', 'video'))
+
+_document = '#document'
+_end = object()
+
+# Compact documents refer to tags by their index in _tag_names.
+_tag_names = tuple(_elements)
+_tag_ids = {tag: i for i, tag in enumerate(_tag_names)}
+_tag_allow = tuple(_elements[tag]['allow'] for tag in _tag_names)
+_heading_tags = frozenset(_tag_ids[f'h{level}'] for level in range(1, 7))
+
+# Tags in raw html that separate words, and all the others.
+_raw_block_tags = _re.compile(r'</?(?:br|div|li|ol|p|pre|ul)\b[^>]*>')
+_raw_tags = _re.compile(r'<[^>]*>')
+
+
+# A document that keeps its nodes in flat arrays instead of one object per
+# node, which takes a fraction of the memory. Node 0 is the document itself.
+# For node i, kinds[i] says what it is and values[i] is the index of its tag
+# in _tag_names for an element, or of its text in strings otherwise. The
+# children of a node are linked through first_child and next_sibling (with
+# -1 for none), and its attributes, in the order they were set, through
+# first_attribute and next_attribute, which index the attribute_names and
+# attribute_values of the document.
+#
+# Elements are passed around as _Node handles, and add_element, add_text,
+# add_html and set_attribute take them just like regular elements.
+class CompactHtml:
+    __slots__ = (
+        'ids', 'kinds', 'values', 'first_child', 'last_child', 'next_sibling',
+        'first_attribute', 'strings', 'attribute_names', 'attribute_values', 'next_attribute',
+    )
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.kinds = _array.array('B', (_ROOT,))
+        self.values = _array.array('i', (0,))
+        self.first_child = _array.array('i', (-1,))
+        self.last_child = _array.array('i', (-1,))
+        self.next_sibling = _array.array('i', (-1,))
+        self.first_attribute = _array.array('i', (-1,))
+        self.strings = []
+        self.attribute_names = []
+        self.attribute_values = []
+        self.next_attribute = _array.array('i')
+
+
+    doc = property(lambda self: self)
+    index = 0
+
+
+    def __repr__(self):
+        return f'CompactHtml({len(self.kinds) - 1} nodes)'
+
+
+    def allow(self, node):
+        if _ROOT == self.kinds[node]:
+            return _ContentType.NOTEXT
+        return _tag_allow[self.values[node]]
+
+
+    def add_element(self, parent, tag):
+        assert _ContentType.NONE != self.allow(parent), f'Tried to add element to {_Node(self, parent)}'
+        return _Node(self, self._add_node(parent, _ELEMENT, _tag_ids[tag]))
+
+
+    def add_html(self, parent, html):
+        assert _ContentType.NONE != self.allow(parent), f'Tried to add html to {_Node(self, parent)}'
+        self.strings.append(html)
+        self._add_node(parent, _RAW, len(self.strings) - 1)
+
+
+    def add_text(self, parent, text, omit_if_whitespace):
+        if _ContentType.ANY != self.allow(parent):
+            assert '' == text.strip(), f"{_Node(self, parent)}: can't accept text '{text}'"
+            return
+
+        prev = self.last_child[parent]
+        kind = self.kinds[prev] if -1 != prev else None
+        if 'pre' == _tag_names[self.values[parent]]:
+            if _PREFORMATTED == kind:
+                self.strings[self.values[prev]] += text
+                return
+            kind = _PREFORMATTED
+        elif (_TEXT == kind) or (_KEPT_TEXT == kind):
+            self.strings[self.values[prev]] += text
+            if not omit_if_whitespace:
+                self.kinds[prev] = _KEPT_TEXT
+            return
+        else:
+            kind = _TEXT if omit_if_whitespace else _KEPT_TEXT
+        self.strings.append(text)
+        self._add_node(parent, kind, len(self.strings) - 1)
+
+
+    def set_attribute(self, node, name, value):
+        prev = -1
+        attribute = self.first_attribute[node]
+        while -1 != attribute:
+            assert name != self.attribute_names[attribute], f'Attribute {name} already set'
+            prev = attribute
+            attribute = self.next_attribute[attribute]
+
+        attribute = len(self.attribute_names)
+        self.attribute_names.append(name)
+        self.attribute_values.append(value)
+        self.next_attribute.append(-1)
+        if -1 == prev:
+            self.first_attribute[node] = attribute
+        else:
+            self.next_attribute[prev] = attribute
+
+        if 'id' == name:
+            assert value not in self.ids, f"id '{value}' already exists in document"
+            self.ids.add(value)
+
+
+    def _add_node(self, parent, kind, value):
+        node = len(self.kinds)
+        self.kinds.append(kind)
+        self.values.append(value)
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        self.next_sibling.append(-1)
+        self.first_attribute.append(-1)
+
+        prev = self.last_child[parent]
+        if -1 == prev:
+            self.first_child[parent] = node
+        else:
+            self.next_sibling[prev] = node
+        self.last_child[parent] = node
+        return node
+
+
+_ROOT, _ELEMENT, _TEXT, _KEPT_TEXT, _PREFORMATTED, _RAW = range(6)
+
+
+class _Node:
+    __slots__ = 'doc', 'index'
+
+    def __init__(self, doc, index):
+        self.doc = doc
+        self.index = index
+
+
+    def __repr__(self):
+        return f'Element({_tag_names[self.doc.values[self.index]]})'
+
+
+_compact = (CompactHtml, _Node)
+
+
 class _DocType:
     __slots__ = 'doctype',
 
@@ -321,6 +963,31 @@ class _Text:
 
 
 
+class _BufferedWriter:
+    __slots__ = 'fh', 'buffer_size', 'chunks', 'size'
+
+    def __init__(self, fh, buffer_size):
+        self.fh = fh
+        self.buffer_size = buffer_size
+        self.chunks = []
+        self.size = 0
+
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+
+    def flush(self):
+        if self.chunks:
+            self.fh.write(''.join(self.chunks))
+            self.chunks = []
+            self.size = 0
+
+
+
 class _Iterator:
 
     def __init__(self, items):
@@ -0,0 +1,381 @@
+import concurrent.futures as _futures
+import contextlib as _contextlib
+import gzip as _gzip
+import hashlib as _hashlib
+import os as _os
+import queue as _queue
+import shutil as _shutil
+import threading as _threading
+import time as _time
+
+try:
+    import brotli as _brotli
+except ImportError:
+    _brotli = None
+
+
+# Files with these extensions get precompressed siblings, one per compressor,
+# which static file servers can send as is instead of compressing on the fly.
+compressed_types = ('.html', '.css', '.js', '.json')
+compressors = {
+    '.gz': lambda data: _gzip.compress(data, 9, mtime=0),
+}
+if _brotli is not None:
+    compressors['.br'] = lambda data: _brotli.compress(data, quality=11)
+
+# With fsync, written files are synced and moved into place this many at a
+# time, so that the directory only has to be synced once per batch.
+fsync_batch = 32
+
+
+class Report:
+    __slots__ = (
+        'added', 'changed', 'unchanged', 'removed', 'compressed', 'size', 'write_time', 'wait_time')
+
+    def __init__(self):
+        self.added = []
+        self.changed = []
+        self.unchanged = []
+        self.removed = []
+        self.compressed = []
+        self.size = 0
+        # Seconds writer threads spent writing files, added up over all of
+        # them, and seconds the build spent waiting for a writer to take a
+        # file. Without writer threads, writing is timed by the profile.
+        self.write_time = 0
+        self.wait_time = 0
+
+
+    def __str__(self):
+        result = '{} added, {} changed, {} unchanged, {} removed'.format(
+            len(self.added), len(self.changed), len(self.unchanged), len(self.removed))
+        if self.compressed:
+            result += f', {len(self.compressed)} compressed'
+        if self.write_time > 0:
+            result += ', {:.1f} MB at {:.1f} MB/s'.format(
+                self.size / 1e6, self.size / 1e6 / self.write_time)
+        if self.wait_time >= 0.001:
+            result += f', {self.wait_time * 1000:.0f} ms waiting for writers'
+        return result
+
+
+
+# Writes files to staging first and only moves them to directory once they
+# are complete, leaving files whose content didn't change untouched. With
+# writers, the files opened by open() go to that many threads in turn, and
+# whatever is written to them is handed to the file's thread through a queue
+# of at most queue_size chunks, so that the rest of a page can be rendered
+# while the start of it is being written.
+class Output:
+    __slots__ = (
+        'directory', 'staging', 'keep', 'compress', 'workers', 'fsync', 'written', 'digests', 'report',
+        'writers', '_queues', '_next', '_threads', '_lock', '_error', '_pending')
+
+    def __init__(
+            self, directory, staging, keep=(), compress=False, workers=None, writers=0,
+            queue_size=None, fsync=False):
+        self.directory = directory
+        self.staging = staging
+        self.keep = set(keep)
+        self.compress = compress
+        self.workers = workers
+        self.writers = writers
+        self.fsync = fsync
+        self.written = set()
+        # The SHA-256 of the content of every written file.
+        self.digests = {}
+        self.report = Report()
+        self._lock = _threading.Lock()
+        self._error = None
+        self._pending = []
+        _os.makedirs(directory, exist_ok=True)
+        _os.makedirs(staging, exist_ok=True)
+
+        self._queues = [_queue.Queue(queue_size or 4) for _ in range(writers)]
+        self._next = 0
+        self._threads = [
+            _threading.Thread(target=self._write_files, args=(queue,), name=f'output-{i}', daemon=True)
+            for i, queue in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+
+    @_contextlib.contextmanager
+    def open(self, name):
+        self._raise_error()
+        self._claim(name)
+        if self._threads:
+            fh = _QueuedFile(self, self._queues[self._next], name)
+            self._next = (self._next + 1) % len(self._queues)
+            try:
+                yield fh
+            except BaseException:
+                fh.put(_aborted)
+                self._unclaim(name)
+                raise
+            fh.put(None)
+            return
+
+        staged = _os.path.join(self.staging, name)
+        try:
+            with open(staged, 'w') as fh:
+                yield fh
+        except BaseException:
+            _remove(staged)
+            self._unclaim(name)
+            raise
+        self._stored(name, self._pending)
+
+
+    def write(self, name, text):
+        with self.open(name) as fh:
+            fh.write(text)
+
+
+    def retain(self, name):
+        assert name not in self.written, f'{name} was already written'
+        self.keep.add(name)
+
+
+    def _claim(self, name):
+        assert name not in self.written, f'{name} was written twice'
+        self.written.add(name)
+
+
+    # A file that failed to be written counts as not written at all, so that
+    # finish() removes whatever is left of it in directory.
+    def _unclaim(self, name):
+        self.written.discard(name)
+
+
+    def _commit(self, name):
+        staged = _os.path.join(self.staging, name)
+        target = _os.path.join(self.directory, name)
+        digest = hash_file(staged)
+        size = _os.path.getsize(staged)
+        try:
+            existing = hash_file(target)
+        except FileNotFoundError:
+            existing = None
+
+        if existing == digest:
+            _os.remove(staged)
+            listing = self.report.unchanged
+        else:
+            _os.replace(staged, target)
+            listing = self.report.changed if existing is not None else self.report.added
+        with self._lock:
+            self.digests[name] = digest
+            self.report.size += size
+            listing.append(name)
+        return digest
+
+
+    # Called once name is complete in staging. With fsync, it only gets moved
+    # into place with the rest of its batch.
+    def _stored(self, name, pending):
+        if not self.fsync:
+            self._commit(name)
+        else:
+            pending.append(name)
+            if len(pending) >= fsync_batch:
+                self._sync(pending)
+
+
+    # Make sure every file in pending is on disk before any of them replaces
+    # its target, and then that the replacements are.
+    def _sync(self, pending):
+        for name in pending:
+            fd = _os.open(_os.path.join(self.staging, name), _os.O_RDONLY)
+            try:
+                _os.fsync(fd)
+            finally:
+                _os.close(fd)
+        for name in pending:
+            self._commit(name)
+        pending.clear()
+        _fsync_directory(self.directory)
+
+
+    # Runs in a writer thread. Every job is a file name with the next chunk
+    # of it, None once it is complete or _aborted if it won't be.
+    def _write_files(self, queue):
+        files = {}
+        pending = []
+        elapsed = 0
+        while True:
+            job = queue.get()
+            if job is None:
+                break
+            # After an error, only empty the queue so that writing doesn't
+            # block; the error is raised by the next open() or by close().
+            if self._error is None:
+                start = _time.perf_counter()
+                try:
+                    self._write_chunk(files, pending, *job)
+                except BaseException as e:
+                    self._error = e
+                elapsed += _time.perf_counter() - start
+
+        for name, fh in files.items():
+            fh.close()
+            _remove(_os.path.join(self.staging, name))
+        if self._error is None and pending:
+            start = _time.perf_counter()
+            try:
+                self._sync(pending)
+            except BaseException as e:
+                self._error = e
+            elapsed += _time.perf_counter() - start
+        with self._lock:
+            self.report.write_time += elapsed
+
+
+    def _write_chunk(self, files, pending, name, text):
+        staged = _os.path.join(self.staging, name)
+        fh = files.get(name)
+        if text is _aborted:
+            if fh is not None:
+                del files[name]
+                fh.close()
+                _remove(staged)
+            return
+
+        if fh is None:
+            fh = files[name] = open(staged, 'w')
+        if text is None:
+            del files[name]
+            fh.close()
+            self._stored(name, pending)
+        else:
+            fh.write(text)
+
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError('Writing the output failed') from self._error
+
+
+    # Wait for every file to be written.
+    def close(self):
+        for queue in self._queues:
+            queue.put(None)
+        self._queues = []
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._raise_error()
+        if self._pending:
+            self._sync(self._pending)
+
+
+    def finish(self):
+        self.close()
+        siblings = self.compress_files() if self.compress else ()
+        with _os.scandir(self.directory) as it:
+            for entry in it:
+                if (entry.name in self.written) or (entry.name in self.keep) or (entry.name in siblings):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    _shutil.rmtree(entry.path)
+                else:
+                    _os.remove(entry.path)
+                self.report.removed.append(entry.name)
+        self.report.removed.sort()
+
+        try:
+            _os.rmdir(self.staging)
+        except OSError:
+            pass
+        return self.report
+
+
+    def compress_files(self):
+        changed = set(self.report.added)
+        changed.update(self.report.changed)
+        siblings = set()
+        jobs = []
+        for name in sorted(self.written | self.keep):
+            if not name.endswith(compressed_types):
+                continue
+            for suffix in compressors:
+                sibling = name + suffix
+                siblings.add(sibling)
+                # A file whose content didn't change still has a valid
+                # sibling from the build that wrote it.
+                if (name in changed) or not _os.path.exists(_os.path.join(self.directory, sibling)):
+                    jobs.append((name, suffix))
+
+        # zlib and brotli release the GIL while compressing, so threads are
+        # enough to compress several files at once.
+        with _futures.ThreadPoolExecutor(self.workers) as pool:
+            for sibling in pool.map(self._compress_file, jobs):
+                self.report.compressed.append(sibling)
+        return siblings
+
+
+    def _compress_file(self, job):
+        name, suffix = job
+        with open(_os.path.join(self.directory, name), 'rb') as fh:
+            data = compressors[suffix](fh.read())
+        sibling = name + suffix
+        staged = _os.path.join(self.staging, sibling)
+        with open(staged, 'wb') as fh:
+            fh.write(data)
+        _os.replace(staged, _os.path.join(self.directory, sibling))
+        return sibling
+
+
+# Queued after the chunks of a file that failed to be written in full.
+_aborted = object()
+
+
+class _QueuedFile:
+    __slots__ = 'output', 'queue', 'name'
+
+    def __init__(self, output, queue, name):
+        self.output = output
+        self.queue = queue
+        self.name = name
+
+
+    def write(self, text):
+        if text:
+            self.put(text)
+
+
+    def put(self, text):
+        start = _time.perf_counter()
+        self.queue.put((self.name, text))
+        self.output.report.wait_time += _time.perf_counter() - start
+
+
+
+def hash_file(filename):
+    digest = _hashlib.sha256()
+    with open(filename, 'rb') as fh:
+        while True:
+            chunk = fh.read(64 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _fsync_directory(directory):
+    # Directories can't be opened, let alone synced, on Windows.
+    if _os.name == 'nt':
+        return
+    fd = _os.open(directory, _os.O_RDONLY)
+    try:
+        _os.fsync(fd)
+    finally:
+        _os.close(fd)
+
+
+def _remove(filename):
+    try:
+        _os.remove(filename)
+    except FileNotFoundError:
+        pass
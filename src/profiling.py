@@ -0,0 +1,206 @@
+import collections as _collections
+import json as _json
+import time as _time
+
+
+class Profile:
+    __slots__ = 'phases', 'pages', 'counts', 'stack', 'start'
+
+    def __init__(self):
+        self.phases = {}
+        self.pages = {}
+        self.counts = _collections.Counter()
+        self.stack = []
+        self.start = (_time.perf_counter(), _time.process_time())
+
+
+    def __bool__(self):
+        return True
+
+
+    def timer(self, phase, page=None):
+        return _Timer(self, phase, page)
+
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+
+    def add(self, phase, page, wall, cpu, calls=1):
+        _add(self.phases, phase, wall, cpu, calls)
+        if page is not None:
+            _add(self.pages.setdefault(page, {}), phase, wall, cpu, calls)
+
+
+    def merge(self, data):
+        for phase, (wall, cpu, calls) in data['phases'].items():
+            _add(self.phases, phase, wall, cpu, calls)
+        for page, phases in data['pages'].items():
+            for phase, (wall, cpu, calls) in phases.items():
+                _add(self.pages.setdefault(page, {}), phase, wall, cpu, calls)
+        self.counts.update(data['counts'])
+
+
+    def data(self):
+        return {
+            'phases': self.phases,
+            'pages': self.pages,
+            'counts': dict(self.counts),
+        }
+
+
+    def report(self):
+        wall = _time.perf_counter() - self.start[0]
+        cpu = _time.process_time() - self.start[1]
+        result = {
+            'total': {'wall': wall, 'cpu': cpu},
+            'phases': {
+                phase: {'wall': wall, 'cpu': cpu, 'calls': calls}
+                for phase, (wall, cpu, calls) in self.phases.items()
+            },
+            'pages': {
+                page: {
+                    phase: {'wall': wall, 'cpu': cpu, 'calls': calls}
+                    for phase, (wall, cpu, calls) in phases.items()
+                }
+                for page, phases in self.pages.items()
+            },
+            'counts': dict(self.counts),
+        }
+        return result
+
+
+    def summary(self, pages=10):
+        report = self.report()
+        lines = []
+        total = report['total']
+        lines.append(f"Total: {total['wall'] * 1000:.1f} ms wall, {total['cpu'] * 1000:.1f} ms cpu")
+
+        lines.append('')
+        lines.append(f"{'phase':<16} {'wall ms':>10} {'cpu ms':>10} {'calls':>8}")
+        phases = sorted(report['phases'].items(), key=lambda item: item[1]['wall'], reverse=True)
+        for phase, times in phases:
+            lines.append('{:<16} {:>10.1f} {:>10.1f} {:>8}'.format(
+                phase, times['wall'] * 1000, times['cpu'] * 1000, times['calls']))
+
+        if report['pages']:
+            lines.append('')
+            lines.append(f"{'page':<24} {'wall ms':>10} {'cpu ms':>10}")
+            totals = [
+                (page, sum(t['wall'] for t in phases.values()), sum(t['cpu'] for t in phases.values()))
+                for page, phases in report['pages'].items()
+            ]
+            totals.sort(key=lambda item: item[1], reverse=True)
+            for page, wall, cpu in totals[:pages]:
+                lines.append(f'{page:<24} {wall * 1000:>10.1f} {cpu * 1000:>10.1f}')
+
+        if report['counts']:
+            lines.append('')
+            for name, n in sorted(report['counts'].items()):
+                lines.append(f'{name:<24} {n:>10}')
+
+        return '\n'.join(lines)
+
+
+    def write(self, filename):
+        with open(filename, 'w') as fh:
+            _json.dump(self.report(), fh, indent=2, sort_keys=True)
+
+
+
+class NullProfile:
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+
+    def timer(self, phase, page=None):
+        return _null_timer
+
+
+    def count(self, name, n=1):
+        pass
+
+
+    def merge(self, data):
+        pass
+
+
+    def data(self):
+        return None
+
+
+
+class TimedFile:
+    __slots__ = 'fh', 'profile', 'phase'
+
+    def __init__(self, fh, profile, phase):
+        self.fh = fh
+        self.profile = profile
+        self.phase = phase
+
+
+    def write(self, text):
+        with self.profile.timer(self.phase):
+            return self.fh.write(text)
+
+
+
+class _Timer:
+    __slots__ = 'profile', 'phase', 'page', 'wall', 'cpu', 'child_wall', 'child_cpu'
+
+    def __init__(self, profile, phase, page):
+        self.profile = profile
+        self.phase = phase
+        self.page = page
+
+
+    def __enter__(self):
+        stack = self.profile.stack
+        if (self.page is None) and stack:
+            self.page = stack[-1].page
+        stack.append(self)
+        self.child_wall = self.child_cpu = 0
+        self.wall = _time.perf_counter()
+        self.cpu = _time.process_time()
+        return self
+
+
+    def __exit__(self, *exc):
+        wall = _time.perf_counter() - self.wall
+        cpu = _time.process_time() - self.cpu
+        stack = self.profile.stack
+        stack.pop()
+        # Phases are reported by self time, so that nested phases don't
+        # count towards the phase that encloses them.
+        self.profile.add(self.phase, self.page, wall - self.child_wall, cpu - self.child_cpu)
+        if stack:
+            stack[-1].child_wall += wall
+            stack[-1].child_cpu += cpu
+        return False
+
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def _add(phases, phase, wall, cpu, calls):
+    if phase in phases:
+        entry = phases[phase]
+        entry[0] += wall
+        entry[1] += cpu
+        entry[2] += calls
+    else:
+        phases[phase] = [wall, cpu, calls]
@@ -0,0 +1,118 @@
+import collections as _collections
+import json as _json
+import marshal as _marshal
+import os as _os
+import re as _re
+
+import htmltools as _htmltools
+
+
+# A word in a heading counts as much as this many words in the text.
+heading_weight = 20
+min_word_length = 2
+
+# Front coding stores how many leading characters a term shares with the one
+# before it as a single digit in this alphabet, so that's as many as it can
+# share.
+_digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+_words = _re.compile(r'\w+')
+
+
+# The searchable text of a page, split up at every heading that has an
+# anchor: a list of (anchor, title, terms), where anchor is None for the text
+# before the first such heading and terms is a sorted list of (term, weight).
+def page_sections(article, headings):
+    titles = {id: name for _, name, id in headings}
+    sections = {}
+    for anchor, heading, text in _htmltools.iter_text(article):
+        if anchor not in titles:
+            anchor = None
+        if anchor in sections:
+            title, terms = sections[anchor]
+        else:
+            title, terms = titles.get(anchor), _collections.Counter()
+            sections[anchor] = [title, terms]
+        if heading and (title is None):
+            sections[anchor][0] = text.strip() or None
+        weight = heading_weight if heading else 1
+        for word in _words.findall(text.lower()):
+            if len(word) >= min_word_length:
+                terms[word] += weight
+
+    result = [
+        (anchor, title, sorted(terms.items()))
+        for anchor, (title, terms) in sections.items() if terms
+    ]
+    return result
+
+
+# A page's sections are stored with the key of what they were made from, so
+# that they're only made again, and only trusted, for the same key.
+def save_page(directory, page, key, sections):
+    filename = f'{directory}/{page}.bin'
+    _os.makedirs(directory, exist_ok=True)
+    with open(f'{filename}.{_os.getpid()}.tmp', 'wb') as fh:
+        fh.write(f'{key}\n'.encode('ascii'))
+        fh.write(_marshal.dumps(sections))
+    _os.replace(f'{filename}.{_os.getpid()}.tmp', filename)
+
+
+def load_page(directory, page):
+    with open(f'{directory}/{page}.bin', 'rb') as fh:
+        fh.readline()
+        return _marshal.loads(fh.read())
+
+
+def has_page(directory, page, key):
+    try:
+        with open(f'{directory}/{page}.bin', 'rb') as fh:
+            return fh.readline() == f'{key}\n'.encode('ascii')
+    except OSError:
+        return False
+
+
+# Build the index of every page from what save_page stored for it, one page
+# at a time. The index is JSON with:
+#
+#   documents: [url, title] for every section of every page
+#   terms: every term in sorted order, front coded: the first character is
+#       the number of leading characters the term shares with the one before
+#       it (in _digits) and the rest is what follows them
+#   postings: for every term, the documents it occurs in as a flat list of
+#       [document, weight, ...], where each document is stored as the
+#       difference to the one before it
+def build_index(directory, pages):
+    documents = []
+    postings = {}
+    for page in pages:
+        for anchor, title, terms in load_page(directory, page):
+            document = len(documents)
+            url = f'{page}.html#{anchor}' if anchor else f'{page}.html'
+            documents.append((url, title or page))
+            for term, weight in terms:
+                if term in postings:
+                    postings[term].append((document, weight))
+                else:
+                    postings[term] = [(document, weight)]
+
+    terms = []
+    lists = []
+    previous = ''
+    for term in sorted(postings):
+        shared = 0
+        limit = min(len(term), len(previous), len(_digits) - 1)
+        while (shared < limit) and (term[shared] == previous[shared]):
+            shared += 1
+        terms.append(_digits[shared] + term[shared:])
+        previous = term
+
+        flat = []
+        last = 0
+        for document, weight in postings[term]:
+            flat.append(document - last)
+            flat.append(weight)
+            last = document
+        lists.append(flat)
+
+    index = {'documents': documents, 'terms': terms, 'postings': lists}
+    return _json.dumps(index, ensure_ascii=False, separators=(',', ':'))
@@ -0,0 +1,244 @@
+import collections as _collections
+import concurrent.futures as _futures
+import json as _json
+import os as _os
+import sys as _sys
+import threading as _threading
+import time as _time
+import urllib.parse as _urlparse
+
+
+Result = _collections.namedtuple('Result', ('url', 'status', 'final_url', 'error'))
+
+
+user_agent = f'Python-urllib/{_sys.version_info[0]}.{_sys.version_info[1]}'
+max_redirects = 10
+
+# http.client, with the email package it needs, is only imported once a url
+# is actually checked.
+_httpclient = None
+
+
+class Checker:
+    __slots__ = 'workers', 'per_host', 'timeout', 'retries', 'backoff', 'cache', '_hosts', '_lock'
+
+    def __init__(self, workers=8, per_host=2, timeout=10, retries=2, backoff=0.5, cache=None):
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self._hosts = {}
+        self._lock = _threading.Lock()
+
+
+    def check(self, urls):
+        results = {}
+        pending = []
+        for url in urls:
+            result = self.cache.get(url) if self.cache is not None else None
+            if result:
+                results[url] = result
+            else:
+                pending.append(url)
+
+        try:
+            with _futures.ThreadPoolExecutor(self.workers) as pool:
+                futures = {pool.submit(self.check_url, url): url for url in pending}
+                for future in _futures.as_completed(futures):
+                    result = future.result()
+                    results[result.url] = result
+        finally:
+            self.close()
+
+        if self.cache is not None:
+            for url in pending:
+                self.cache.add(results[url])
+            self.cache.save()
+        return results
+
+
+    def check_url(self, url):
+        if _httpclient is None:
+            _load_http()
+        attempt = 0
+        while True:
+            try:
+                status, final_url = self._follow(url)
+            except OSError as e:
+                result = Result(url, None, None, str(e) or e.__class__.__name__)
+            except _httpclient.HTTPException as e:
+                # A malformed response or a redirect loop won't go away by
+                # asking again; only connection errors, 429 and 5xx might.
+                return Result(url, None, None, str(e) or e.__class__.__name__)
+            else:
+                result = Result(url, status, final_url, None)
+                if not _should_retry(status):
+                    return result
+
+            if attempt >= self.retries:
+                return result
+            _time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+
+    def close(self):
+        with self._lock:
+            hosts = self._hosts
+            self._hosts = {}
+        for host in hosts.values():
+            host.close()
+
+
+    def _follow(self, url):
+        current = url
+        for _ in range(max_redirects + 1):
+            status, location = self._head(current)
+            if location and (300 <= status < 400):
+                current = _urlparse.urljoin(current, location)
+            else:
+                return status, current
+        raise _httpclient.HTTPException(f'Exceeded {max_redirects} redirects')
+
+
+    def _head(self, url):
+        parts = _urlparse.urlsplit(url)
+        assert parts.scheme in ('http', 'https'), f'Unsupported url: {url}'
+        path = parts.path or '/'
+        if parts.query:
+            path = f'{path}?{parts.query}'
+
+        host = self._get_host(parts.scheme, parts.netloc)
+        with host.semaphore:
+            while True:
+                conn, reused = host.acquire()
+                try:
+                    conn.request('HEAD', path, headers={'User-Agent': user_agent})
+                    response = conn.getresponse()
+                    response.read()
+                except (OSError, _httpclient.HTTPException):
+                    conn.close()
+                    # The server may have closed an idle keep-alive
+                    # connection, so retry on a fresh one.
+                    if reused:
+                        continue
+                    raise
+                break
+            if response.will_close:
+                conn.close()
+            else:
+                host.release(conn)
+        return response.status, response.getheader('Location')
+
+
+    def _get_host(self, scheme, netloc):
+        key = (scheme, netloc)
+        with self._lock:
+            host = self._hosts.get(key)
+            if host is None:
+                host = _Host(scheme, netloc, self.per_host, self.timeout)
+                self._hosts[key] = host
+        return host
+
+
+
+class _Host:
+    __slots__ = 'scheme', 'netloc', 'timeout', 'semaphore', 'idle', 'lock'
+
+    def __init__(self, scheme, netloc, per_host, timeout):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self.semaphore = _threading.BoundedSemaphore(per_host)
+        self.idle = []
+        self.lock = _threading.Lock()
+
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        if 'https' == self.scheme:
+            conn = _httpclient.HTTPSConnection(self.netloc, timeout=self.timeout)
+        else:
+            conn = _httpclient.HTTPConnection(self.netloc, timeout=self.timeout)
+        return conn, False
+
+
+    def release(self, conn):
+        with self.lock:
+            self.idle.append(conn)
+
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            conn.close()
+
+
+
+class Cache:
+    __slots__ = 'filename', 'ttl', 'entries', 'hits', 'misses'
+
+    version = 1
+
+    def __init__(self, filename, ttl, recheck=False):
+        self.filename = filename
+        self.ttl = ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if not recheck:
+            self.load()
+
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as fh:
+                cache = _json.load(fh)
+        except (OSError, ValueError):
+            return
+        if self.version == cache.get('version'):
+            self.entries = cache['urls']
+
+
+    def save(self):
+        _os.makedirs(_os.path.dirname(self.filename) or '.', exist_ok=True)
+        tmp = f'{self.filename}.tmp'
+        with open(tmp, 'w') as fh:
+            _json.dump({'version': self.version, 'urls': self.entries}, fh)
+        _os.replace(tmp, self.filename)
+
+
+    def get(self, url):
+        entry = self.entries.get(url)
+        if entry:
+            status, final_url, checked = entry
+            if _time.time() - checked < self.ttl:
+                self.hits += 1
+                return Result(url, status, final_url, None)
+        self.misses += 1
+        return None
+
+
+    def add(self, result):
+        # Only remember links that checked out. A broken link fails the
+        # build anyway, and a transient failure shouldn't stick around.
+        if (result.error is None) and (200 == result.status):
+            self.entries[result.url] = [result.status, result.final_url, _time.time()]
+        else:
+            self.entries.pop(result.url, None)
+
+
+
+def _load_http():
+    global _httpclient
+    import http.client
+    _httpclient = http.client
+
+
+def _should_retry(status):
+    return (429 == status) or (status >= 500)